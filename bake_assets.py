@@ -0,0 +1,110 @@
+# author: Paul Kim
+# date: October 9, 2022
+# version: 1.0
+import argparse
+import json
+import os
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import pygame
+
+from main import BAKED_ASSETS_DIR, PRELOAD_FOLDERS, SCALED_ASSETS
+
+ATLAS_WIDTH = 2048
+
+
+def source_stamp(path):
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def image_key(path, size):
+    return path if size is None else f'{path}@{size[0]}x{size[1]}'
+
+
+def animation_sets(folders=PRELOAD_FOLDERS, scaled=SCALED_ASSETS):
+    for folder in folders:
+        for directory, _, img_files in sorted(os.walk(folder)):
+            if img_files:
+                name = directory.replace('assets/', '', 1).replace('/', '_') + '.png'
+                yield name, [(directory + '/' + image, None) for image in sorted(img_files)]
+    yield 'scaled.png', list(scaled)
+
+
+def pack(images, width=ATLAS_WIDTH):
+    rects = []
+    x = y = shelf_height = atlas_width = 0
+    for image in images:
+        image_width, image_height = image.get_size()
+        if x and x + image_width > width:
+            x = 0
+            y += shelf_height
+            shelf_height = 0
+        rects.append([x, y, image_width, image_height])
+        x += image_width
+        shelf_height = max(shelf_height, image_height)
+        atlas_width = max(atlas_width, x)
+    return rects, (atlas_width, y + shelf_height)
+
+
+def bake_set(name, sources, output):
+    images = []
+    for path, size in sources:
+        image = pygame.image.load(path).convert_alpha()
+        if size is not None:
+            image = pygame.transform.scale(image, size)
+        images.append(image)
+    rects, atlas_size = pack(images)
+    atlas = pygame.Surface(atlas_size, pygame.SRCALPHA)
+    for image, rect in zip(images, rects):
+        atlas.blit(image, rect[:2], special_flags=pygame.BLEND_RGBA_ADD)
+    pygame.image.save(atlas, os.path.join(output, name))
+    return rects
+
+
+def bake(output=BAKED_ASSETS_DIR, force=False):
+    os.makedirs(output, exist_ok=True)
+    manifest_path = os.path.join(output, 'manifest.json')
+    try:
+        with open(manifest_path) as file:
+            previous = json.load(file)['images']
+    except (OSError, ValueError, KeyError):
+        previous = {}
+    manifest = {'version': 1, 'images': {}, 'folders': {}}
+    baked = reused = 0
+    for name, sources in animation_sets():
+        keys = [image_key(path, size) for path, size in sources]
+        stamps = [source_stamp(path) for path, size in sources]
+        entries = [previous.get(key) for key in keys]
+        if (not force and os.path.exists(os.path.join(output, name)) and
+                all(entry and entry['atlas'] == name and entry['source'] == stamp
+                    for entry, stamp in zip(entries, stamps))):
+            rects = [entry['rect'] for entry in entries]
+            reused += 1
+        else:
+            rects = bake_set(name, sources, output)
+            baked += 1
+        for key, stamp, rect in zip(keys, stamps, rects):
+            manifest['images'][key] = {'atlas': name, 'rect': rect, 'source': stamp}
+        if sources[0][1] is None:
+            directory = os.path.dirname(sources[0][0])
+            manifest['folders'][directory] = {'mtime': os.stat(directory).st_mtime_ns,
+                                              'files': [path for path, size in sources]}
+    with open(manifest_path, 'w') as file:
+        json.dump(manifest, file, indent=1)
+    return baked, reused, len(manifest['images'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pack game images into pre-scaled atlases.')
+    parser.add_argument('--output', default=BAKED_ASSETS_DIR)
+    parser.add_argument('--force', action='store_true', help='rebake every atlas even if its sources are unchanged')
+    args = parser.parse_args()
+    baked, reused, images = bake(args.output, args.force)
+    print(f"{images} images: {baked} atlases baked, {reused} up to date, written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+# author: Paul Kim
+# date: October 9, 2022
+# version: 1.0
+import argparse
+import copy
+import itertools
+import json
+import multiprocessing
+import os
+import signal
+import tempfile
+import time
+from collections import deque
+
+os.environ.setdefault('CAPY_HEADLESS', '1')
+
+import pygame
+
+from benchmark import ScriptedInput, ScriptedKeys, generate_map, git_revision
+from main import FPS, TILESIZE, World, SimulationClock, magic_data, monster_data, weapon_data
+from map_format import convert, load_map
+
+TABLES = {'monster_data': monster_data, 'weapon_data': weapon_data, 'magic_data': magic_data}
+METRICS = ['survived', 'kills', 'clear_s', 'time_to_kill_s', 'damage_taken', 'exp']
+ATTACK_RANGE = TILESIZE * 1.25
+HEAL_BELOW = 0.4
+STUCK_TICKS = 30
+SIDESTEP_TICKS = 20
+GIVE_UP_TICKS = FPS * 5
+IGNORE_TICKS = FPS * 10
+SIDESTEP_KEYS = {pygame.K_LEFT: (pygame.K_UP, pygame.K_DOWN, pygame.K_RIGHT),
+                 pygame.K_RIGHT: (pygame.K_DOWN, pygame.K_UP, pygame.K_LEFT),
+                 pygame.K_UP: (pygame.K_RIGHT, pygame.K_LEFT, pygame.K_DOWN),
+                 pygame.K_DOWN: (pygame.K_LEFT, pygame.K_RIGHT, pygame.K_UP)}
+CHECK_SWEEPS = [('monster_data.mushroom.notice_radius', [100, 200, 900])]
+
+defaults = {}
+maps = {}
+
+
+class BotInput:
+    def __init__(self):
+        self.world = None
+        self.enemies = []
+        self.last_pos = None
+        self.still_ticks = 0
+        self.sidestep = 0
+        self.sidestep_key = None
+        self.attempts = 0
+        self.goal = None
+        self.steps = {}
+        self.ticks = 0
+        self.target = None
+        self.best_distance = None
+        self.progress_tick = 0
+        self.ignored = {}
+
+    def tile(self, pos):
+        return pos[1] // TILESIZE * self.world.obstacle_sprites.cols + pos[0] // TILESIZE
+
+    def opening(self, index):
+        obstacles = self.world.obstacle_sprites
+        col = index % obstacles.cols
+        left_free = col > 0 and not obstacles.cells[index - 1]
+        right_free = col < obstacles.cols - 1 and not obstacles.cells[index + 1]
+        if left_free and right_free:
+            return 0
+        if right_free:
+            return TILESIZE // 2
+        if left_free:
+            return -TILESIZE // 2
+        return None
+
+    def route(self, goal):
+        obstacles = self.world.obstacle_sprites
+        cols = obstacles.cols
+        steps = {goal: goal}
+        frontier = deque([goal])
+        while frontier:
+            index = frontier.popleft()
+            row, col = divmod(index, cols)
+            wide = self.opening(index) is not None
+            neighbours = ((index - cols, wide and row > 0), (index + cols, wide and row < obstacles.rows - 1),
+                          (index - 1, col > 0), (index + 1, col < cols - 1))
+            for neighbour, inside in neighbours:
+                if inside and neighbour not in steps and not obstacles.cells[neighbour]:
+                    steps[neighbour] = index
+                    frontier.append(neighbour)
+        return steps
+
+    def __call__(self):
+        player = self.world.player
+        if player.hp < player.stats['hp'] * HEAL_BELOW and player.mp >= magic_data['heal']['cost']:
+            return ScriptedKeys(frozenset((pygame.K_w,)))
+        self.ticks += 1
+        pressed = set()
+        candidates = [enemy for enemy in self.enemies if enemy.alive() and self.ignored.get(enemy, 0) <= self.ticks]
+        if not candidates:
+            self.ignored.clear()
+            candidates = [enemy for enemy in self.enemies if enemy.alive()]
+        target = min(candidates, default=None,
+                     key=lambda enemy: (enemy.hp, (pygame.math.Vector2(enemy.hitbox.center) -
+                                                   player.hitbox.center).length_squared()))
+        if target is None:
+            return ScriptedKeys(frozenset())
+        dx = target.hitbox.centerx - player.hitbox.centerx
+        dy = target.hitbox.centery - player.hitbox.centery
+        if target is not self.target or abs(dx) + abs(dy) < self.best_distance:
+            self.target = target
+            self.best_distance = abs(dx) + abs(dy)
+            self.progress_tick = self.ticks
+        elif self.ticks - self.progress_tick > GIVE_UP_TICKS:
+            self.ignored[target] = self.ticks + IGNORE_TICKS
+        facing = (pygame.K_RIGHT if dx > 0 else pygame.K_LEFT) if abs(dx) > abs(dy) else \
+            (pygame.K_DOWN if dy > 0 else pygame.K_UP)
+        if abs(dx) < ATTACK_RANGE and abs(dy) < ATTACK_RANGE:
+            self.progress_tick = self.ticks
+            pressed.update((facing, pygame.K_q))
+            if player.mp >= player.stats['mp'] - magic_data['slash']['cost']:
+                pressed.add(pygame.K_e)
+            return ScriptedKeys(frozenset(pressed))
+        if player.hitbox.topleft == self.last_pos:
+            self.still_ticks += 1
+        else:
+            self.still_ticks = 0
+        self.last_pos = player.hitbox.topleft
+        if self.still_ticks > STUCK_TICKS or (self.sidestep and self.still_ticks > STUCK_TICKS // 3):
+            self.attempts += 1
+            self.sidestep = SIDESTEP_TICKS * (1 + self.attempts // 3)
+            self.sidestep_key = SIDESTEP_KEYS[facing][self.attempts % 3]
+            self.still_ticks = 0
+        if self.sidestep:
+            self.sidestep -= 1
+            return ScriptedKeys(frozenset((self.sidestep_key,)))
+        self.attempts = 0
+        goal = self.tile(target.hitbox.center)
+        if goal != self.goal:
+            self.goal = goal
+            self.steps = self.route(goal)
+        start = self.tile(player.hitbox.center)
+        step = self.steps.get(start)
+        if step is not None and step != goal:
+            cols = self.world.obstacle_sprites.cols
+            dx = step % cols * TILESIZE + TILESIZE // 2 - player.hitbox.centerx
+            dy = step // cols * TILESIZE + TILESIZE // 2 - player.hitbox.centery
+            if abs(step - start) == cols:
+                dx += self.opening(step) or 0
+        if abs(dx) > player.speed:
+            pressed.add(pygame.K_RIGHT if dx > 0 else pygame.K_LEFT)
+        if abs(dy) > player.speed:
+            pressed.add(pygame.K_DOWN if dy > 0 else pygame.K_UP)
+        return ScriptedKeys(frozenset(pressed))
+
+
+class ScriptedBot(ScriptedInput):
+    def __init__(self):
+        super().__init__()
+        self.world = None
+        self.enemies = []
+
+    def __call__(self):
+        keys = super().__call__()
+        self.advance()
+        return keys
+
+
+BOTS = {'ai': BotInput, 'scripted': ScriptedBot}
+
+
+def parse_sweep(sweep):
+    path, _, values = sweep.partition('=')
+    table, *keys = path.split('.')
+    entry = TABLES.get(table)
+    for key in keys[:-1]:
+        entry = entry.get(key) if isinstance(entry, dict) else None
+    if entry is None or not keys or keys[-1] not in entry:
+        raise argparse.ArgumentTypeError(f'unknown parameter {path}')
+    return path, [json.loads(value) for value in values.split(',')]
+
+
+def parameter_sets(sweeps):
+    paths = [path for path, values in sweeps]
+    return [dict(zip(paths, combination)) for combination in itertools.product(*(values for path, values in sweeps))]
+
+
+def apply_overrides(overrides):
+    for name, table in TABLES.items():
+        table.clear()
+        table.update(copy.deepcopy(defaults[name]))
+    for path, value in overrides.items():
+        table, *keys = path.split('.')
+        entry = TABLES[table]
+        for key in keys[:-1]:
+            entry = entry[key]
+        entry[keys[-1]] = value
+
+
+def init_worker():
+    # SDL turns SIGTERM into a quit event, which would stop Pool.terminate from ending the worker
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    defaults.update(copy.deepcopy(TABLES))
+
+
+def run_simulation(job):
+    index, overrides, map_path, seed, ticks, bot_name, activation = job
+    apply_overrides(overrides)
+    if map_path not in maps:
+        maps[map_path] = load_map(map_path)
+    clock = SimulationClock()
+    bot = BOTS[bot_name]()
+    world = World(maps[map_path], clock=clock, headless=True, get_pressed=bot, activation=activation)
+    enemies = [sprite for sprite in world.attackable_sprites if sprite.sprite_type == 'enemy']
+    bot.world = world
+    bot.enemies = enemies
+    player = world.player
+    last_hp = player.hp
+    damage_taken = 0
+    alive = len(enemies)
+    kill_ticks = []
+    tick = 0
+    while tick < ticks and not world.game_over and alive:
+        clock.tick()
+        world.step()
+        tick += 1
+        if player.hp < last_hp:
+            damage_taken += last_hp - player.hp
+        last_hp = player.hp
+        now_alive = sum(1 for enemy in enemies if enemy.alive())
+        kill_ticks.extend([tick] * (alive - now_alive))
+        alive = now_alive
+    world.teardown()
+    return {'index': index, 'seed': seed, 'ticks': tick, 'survived': world.game_over != 'lost',
+            'kills': len(kill_ticks), 'clear_s': tick / FPS if enemies and not alive else None,
+            'time_to_kill_s': kill_ticks[-1] / len(kill_ticks) / FPS if kill_ticks else None,
+            'damage_taken': damage_taken, 'exp': player.exp}
+
+
+def aggregate(runs):
+    summary = {'runs': len(runs)}
+    for metric in METRICS:
+        samples = [run[metric] for run in runs if run[metric] is not None]
+        if samples:
+            summary[metric] = {'mean': sum(samples) / len(samples), 'min': min(samples), 'max': max(samples),
+                               'samples': len(samples)}
+        else:
+            summary[metric] = None
+    return summary
+
+
+def run_batch(sweeps, seeds=4, ticks=FPS * 120, workers=None, bot='ai', cols=30, rows=30, obstacle_density=0.05,
+              monsters=8, bosses=1, activation=True):
+    parameters = parameter_sets(sweeps)
+    workers = workers or os.cpu_count()
+    with tempfile.TemporaryDirectory() as map_dir:
+        map_paths = []
+        for seed in range(seeds):
+            map_path = os.path.join(map_dir, f'arena_{seed}.capymap')
+            convert(generate_map(cols, rows, obstacle_density, monsters, bosses, seed), map_path)
+            map_paths.append(map_path)
+        jobs = [(index, overrides, map_paths[seed], seed, ticks, bot, activation)
+                for index, overrides in enumerate(parameters) for seed in range(seeds)]
+        runs = [[] for _ in parameters]
+        with multiprocessing.Pool(workers, initializer=init_worker) as pool:
+            for run in pool.imap_unordered(run_simulation, jobs, chunksize=max(1, len(jobs) // (workers * 8))):
+                runs[run['index']].append(run)
+    return [{'params': overrides, **aggregate(sorted(parameter_runs, key=lambda run: run['seed']))}
+            for overrides, parameter_runs in zip(parameters, runs)]
+
+
+def check_sweep(seeds=2, ticks=FPS * 30, workers=None):
+    expected = run_batch(CHECK_SWEEPS, seeds, ticks, workers, activation=False)
+    actual = run_batch(CHECK_SWEEPS, seeds, ticks, workers)
+    passed = True
+    for expected_result, actual_result in zip(expected, actual):
+        matches = expected_result == actual_result
+        passed = passed and matches
+        print(f"{str(actual_result['params']):<48} {'matches' if matches else 'DIFFERS FROM'} activation off")
+    return passed
+
+
+def format_metric(summary, metric):
+    value = summary[metric]
+    return f"{'-':>8}" if value is None else f"{value['mean']:8.2f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run headless balance sweeps over the game data tables.')
+    parser.add_argument('--sweep', action='append', type=parse_sweep, default=[], metavar='TABLE.KEY.FIELD=V1,V2',
+                        help='e.g. monster_data.mushroom.hp=80,100,150; repeat to sweep a grid')
+    parser.add_argument('--seeds', type=int, default=4, help='arena maps simulated per parameter set')
+    parser.add_argument('--seconds', type=int, default=120, help='game time limit per simulation')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--bot', choices=list(BOTS), default='ai')
+    parser.add_argument('--cols', type=int, default=30)
+    parser.add_argument('--rows', type=int, default=30)
+    parser.add_argument('--monsters', type=int, default=8)
+    parser.add_argument('--bosses', type=int, default=1)
+    parser.add_argument('--output', default='batch_results.json')
+    parser.add_argument('--check', action='store_true',
+                        help='sweep notice_radius with enemy activation on and off and require identical results')
+    args = parser.parse_args()
+    if args.check:
+        raise SystemExit(0 if check_sweep(workers=args.workers) else 1)
+    start = time.perf_counter()
+    results = run_batch(args.sweep, args.seeds, args.seconds * FPS, args.workers, args.bot, args.cols, args.rows,
+                        monsters=args.monsters, bosses=args.bosses)
+    elapsed = time.perf_counter() - start
+    print(f"{len(results)} parameter sets x {args.seeds} seeds in {elapsed:.1f}s")
+    print(f"{'survived':>8} {'kills':>8} {'clear_s':>8} {'ttk_s':>8} {'damage':>8} {'exp':>8}  params")
+    for result in results:
+        print(' '.join(format_metric(result, metric) for metric in METRICS), ' ', result['params'])
+    report = {'revision': git_revision(), 'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'seconds': elapsed,
+              'seeds': args.seeds, 'time_limit_s': args.seconds, 'bot': args.bot,
+              'map': {'cols': args.cols, 'rows': args.rows, 'monsters': args.monsters, 'bosses': args.bosses},
+              'results': results}
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+# author: Paul Kim
+# date: October 9, 2022
+# version: 1.0
+import argparse
+import copy
+import json
+import os
+import platform
+import random
+import subprocess
+import time
+from operator import attrgetter
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import pygame
+
+from main import FPS, WINDOW, World, SimulationClock, asset_cache, monster_data, profiler
+
+PHASES = ['update', 'enemy_update', 'player_attack_logic', 'custom_draw', 'ui', 'frame']
+COUNTERS = ['sprites drawn', 'collisions tested', 'particles alive']
+SCENARIOS = {'small': {'cols': 40, 'rows': 40, 'obstacle_density': 0.05, 'monsters': 20, 'bosses': 1},
+             'medium': {'cols': 100, 'rows': 100, 'obstacle_density': 0.1, 'monsters': 200, 'bosses': 2},
+             'large': {'cols': 200, 'rows': 200, 'obstacle_density': 0.15, 'monsters': 1000, 'bosses': 5},
+             'crowd': {'cols': 60, 'rows': 60, 'obstacle_density': 0.02, 'monsters': 1500, 'bosses': 5}}
+INPUT_SCRIPT = [(90, (pygame.K_LEFT,)), (90, (pygame.K_DOWN,)), (90, (pygame.K_RIGHT, pygame.K_q)),
+                (90, (pygame.K_UP,)), (90, (pygame.K_DOWN, pygame.K_LEFT)), (30, (pygame.K_e,)),
+                (60, (pygame.K_SPACE, pygame.K_RIGHT)), (30, (pygame.K_w,))]
+RADIUS_CHECKS = [{}, {'attack_radius': 300, 'notice_radius': 200}, {'attack_radius': 100, 'notice_radius': 600},
+                 {'attack_radius': 100, 'notice_radius': 900}]
+
+
+def generate_map(cols, rows, obstacle_density=0.05, monsters=20, bosses=1, seed=0):
+    rng = random.Random(seed)
+    world_map = []
+    for row_index in range(rows):
+        row = []
+        for col_index in range(cols):
+            if row_index in (0, rows - 1) or col_index in (0, cols - 1):
+                row.append('x')
+            elif rng.random() < obstacle_density:
+                row.append(rng.choice('xt'))
+            else:
+                row.append(' ')
+        world_map.append(row)
+    world_map[rows // 2][cols // 2] = 'p'
+    empty_cells = [(row_index, col_index) for row_index in range(1, rows - 1) for col_index in range(1, cols - 1)
+                   if world_map[row_index][col_index] == ' ']
+    for (row_index, col_index), cell in zip(rng.sample(empty_cells, monsters + bosses),
+                                            ['m'] * monsters + ['b'] * bosses):
+        world_map[row_index][col_index] = cell
+    return world_map
+
+
+class ScriptedKeys:
+    def __init__(self, pressed):
+        self.pressed = pressed
+
+    def __getitem__(self, key):
+        return key in self.pressed
+
+
+class ScriptedInput:
+    def __init__(self, script=INPUT_SCRIPT):
+        self.frames = []
+        for duration, keys in script:
+            self.frames.extend([ScriptedKeys(frozenset(keys))] * duration)
+        self.frame = 0
+
+    def __call__(self):
+        return self.frames[self.frame % len(self.frames)]
+
+    def advance(self):
+        self.frame += 1
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def summarize(samples):
+    return {'mean_ms': sum(samples) / len(samples), 'p95_ms': percentile(samples, 0.95),
+            'p99_ms': percentile(samples, 0.99), 'max_ms': max(samples)}
+
+
+def run_scenario(name, frames, seed=0, cols=40, rows=40, obstacle_density=0.05, monsters=20, bosses=1,
+                 batch_ai=False, streaming=False):
+    world_map = generate_map(cols, rows, obstacle_density, monsters, bosses, seed)
+    clock = SimulationClock()
+    player_input = ScriptedInput()
+    load_start = time.perf_counter()
+    world = World(world_map, clock=clock, get_pressed=player_input, batch_ai=batch_ai,
+                  streaming=streaming)
+    load_ms = (time.perf_counter() - load_start) * 1000
+    timings = {phase: [] for phase in PHASES}
+    counters = {counter: [] for counter in COUNTERS}
+    for _ in range(frames):
+        clock.tick(FPS)
+        profiler.begin_frame()
+        WINDOW.fill('white')
+        world.run()
+        profiler.end_frame()
+        for phase in PHASES:
+            timings[phase].append(profiler.last_frame.get(phase, 0.0))
+        for counter in COUNTERS:
+            counters[counter].append(profiler.last_counters.get(counter, 0))
+        player_input.advance()
+        if world.game_over:
+            break
+    return {'scenario': name, 'map': {'cols': cols, 'rows': rows, 'obstacle_density': obstacle_density,
+                                      'monsters': monsters, 'bosses': bosses, 'seed': seed}, 'batch_ai': batch_ai,
+            'streaming': streaming,
+            'frames': len(timings['frame']), 'load_ms': load_ms, 'sprites': len(world.visible_sprites),
+            'enemies_left': len(world.attackable_sprites), 'game_over': world.game_over,
+            'phases': {phase: summarize(samples) for phase, samples in timings.items()},
+            'counters': {counter: sum(samples) / len(samples) for counter, samples in counters.items()},
+            'asset_cache': asset_cache.stats()}
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def draw_sorted_all(camera, player):
+    camera.offset.x = player.rect.centerx - camera.half_width
+    camera.offset.y = player.rect.centery - camera.half_height
+    camera.display_surface.blit(camera.floor_surf, camera.floor_rect.topleft - camera.offset)
+    camera.display_surface.blit(camera.floor_surf2, camera.floor_rect2.topleft - camera.offset)
+    for sprite in sorted(camera.sprites(), key=lambda sprite: sprite.rect.centery):
+        camera.display_surface.blit(sprite.image, sprite.rect.topleft - camera.offset)
+
+
+def time_frames(draw, frames):
+    start = time.perf_counter()
+    for _ in range(frames):
+        draw()
+    return (time.perf_counter() - start) / frames * 1000
+
+
+def depth_sort_benchmark(size, frames):
+    world = World(generate_map(size, size, obstacle_density=0.2, monsters=size, bosses=1))
+    camera = world.visible_sprites
+    baseline = time_frames(lambda: draw_sorted_all(camera, world.player), frames)
+    current = time_frames(lambda: camera.custom_draw(world.player), frames)
+    return {'map': f'{size}x{size}', 'sprites': len(camera), 'baseline_ms': baseline, 'custom_draw_ms': current}
+
+
+class BruteForceEnemyAI:
+    def enemy_update(self, player, enemy_sprites):
+        enemies = [sprite for sprite in enemy_sprites if sprite.sprite_type == 'enemy']
+        for enemy in sorted(enemies, key=attrgetter('spatial_order')):
+            enemy.enemy_update(player)
+
+    def track_enemy(self, enemy):
+        pass
+
+
+def run_digests(world_map, ticks, brute_force=False, **world_options):
+    clock = SimulationClock()
+    player_input = ScriptedInput()
+    world = World(world_map, clock=clock, headless=True, get_pressed=player_input, **world_options)
+    if brute_force:
+        world.enemy_ai = BruteForceEnemyAI()
+    digests = []
+    for _ in range(ticks):
+        clock.tick()
+        world.step()
+        player_input.advance()
+        digests.append(world.digest())
+        if world.game_over:
+            break
+    world.teardown()
+    return digests
+
+
+def first_difference(expected, actual):
+    for tick, (expected_digest, actual_digest) in enumerate(zip(expected, actual)):
+        if expected_digest != actual_digest:
+            return tick + 1
+    return None if len(expected) == len(actual) else min(len(expected), len(actual)) + 1
+
+
+def check_radii(ticks, seed=0):
+    world_map = generate_map(40, 40, 0.05, 20, 1, seed)
+    saved = copy.deepcopy(monster_data)
+    passed = True
+    try:
+        for radii in RADIUS_CHECKS:
+            for monster_info in monster_data.values():
+                monster_info.update(radii)
+            expected = run_digests(world_map, ticks, brute_force=True, activation=False)
+            variants = {'broadphase': run_digests(world_map, ticks, activation=False),
+                        'activation': run_digests(world_map, ticks, activation=True)}
+            for name, digests in variants.items():
+                tick = first_difference(expected, digests)
+                passed = passed and tick is None
+                print(f"{str(radii or 'default radii'):<48} {name:<12} "
+                      f"{'matches brute force' if tick is None else f'differs from tick {tick}'}")
+    finally:
+        monster_data.clear()
+        monster_data.update(saved)
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run generated-world benchmarks off-screen.')
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument('--frames', type=int, default=600)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--batch-ai', action='store_true', help='run enemy AI through the NumPy batch')
+    parser.add_argument('--streaming', action='store_true', help='load the map in chunks around the player')
+    parser.add_argument('--depth-sort', type=int, nargs='*', metavar='SIZE',
+                        help='compare custom_draw against sorting every sprite on SIZE x SIZE maps')
+    parser.add_argument('--check-radii', action='store_true',
+                        help='check the enemy AI shortcuts against brute force with non-default monster radii')
+    args = parser.parse_args()
+    if args.check_radii:
+        raise SystemExit(0 if check_radii(args.frames) else 1)
+    if args.depth_sort is not None:
+        for size in args.depth_sort or [50, 100, 200]:
+            result = depth_sort_benchmark(size, 100)
+            print(f"{result['map']:>9} {result['sprites']:>7} sprites  baseline {result['baseline_ms']:8.3f} ms  "
+                  f"custom_draw {result['custom_draw_ms']:8.3f} ms")
+        return
+    results = []
+    for name in args.scenarios:
+        result = run_scenario(name, args.frames, args.seed, batch_ai=args.batch_ai, streaming=args.streaming,
+                              **SCENARIOS[name])
+        results.append(result)
+        print(f"{name}: {result['sprites']} sprites, {result['frames']} frames, load {result['load_ms']:.1f} ms")
+        cache = result['asset_cache']
+        print(f"  asset cache          {cache['hits']} hits, {cache['misses']} misses ({cache['hit_rate']:.1%}), "
+              f"{cache['entries']} entries, {cache['resident_bytes'] / 1048576:.1f} MiB resident")
+        for phase, summary in result['phases'].items():
+            print(f"  {phase:<20} mean {summary['mean_ms']:7.3f}  p95 {summary['p95_ms']:7.3f}  "
+                  f"p99 {summary['p99_ms']:7.3f} ms")
+    report = {'revision': git_revision(), 'python': platform.python_version(), 'pygame': pygame.version.ver,
+              'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+# author: Paul Kim
+# date: October 9, 2022
+# version: 1.0
+import struct
+from array import array
+
+import pygame
+
+MAGIC = b'CAPYREC1'
+HEADER = struct.Struct('<8sIIHH16s')
+EVENT = struct.Struct('<II')
+RECORDED_KEYS = (pygame.K_UP, pygame.K_DOWN, pygame.K_LEFT, pygame.K_RIGHT, pygame.K_q, pygame.K_w, pygame.K_e,
+                 pygame.K_SPACE)
+
+
+class LoggedKeys:
+    def __init__(self, mask, key_bits):
+        self.mask = mask
+        self.key_bits = key_bits
+
+    def __getitem__(self, key):
+        bit = self.key_bits.get(key)
+        return bit is not None and self.mask >> bit & 1 == 1
+
+
+class InputLog:
+    def __init__(self, keys=RECORDED_KEYS, tick_rate=60, masks=None, events=None, digest=bytes(16)):
+        self.keys = tuple(keys)
+        self.key_bits = {key: bit for bit, key in enumerate(self.keys)}
+        self.tick_rate = tick_rate
+        self.masks = masks if masks is not None else array('H')
+        self.events = events if events is not None else []
+        self.digest = digest
+
+    @property
+    def ticks(self):
+        return len(self.masks)
+
+    def keys_at(self, tick):
+        return LoggedKeys(self.masks[tick], self.key_bits)
+
+    def save(self, path):
+        with open(path, 'wb') as file:
+            file.write(HEADER.pack(MAGIC, len(self.masks), len(self.events), self.tick_rate, len(self.keys),
+                                   self.digest))
+            file.write(array('I', self.keys).tobytes())
+            file.write(self.masks.tobytes())
+            for tick, key in self.events:
+                file.write(EVENT.pack(tick, key))
+
+
+def load_log(path):
+    with open(path, 'rb') as file:
+        data = file.read()
+    magic, ticks, event_count, tick_rate, key_count, digest = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError(f'{path} is not an input log')
+    offset = HEADER.size
+    keys = array('I', data[offset:offset + key_count * 4])
+    offset += key_count * 4
+    masks = array('H', data[offset:offset + ticks * 2])
+    offset += ticks * 2
+    events = list(EVENT.iter_unpack(data[offset:offset + event_count * EVENT.size]))
+    return InputLog(keys, tick_rate, masks, events, digest)
+
+
+class InputRecorder:
+    def __init__(self, get_pressed=pygame.key.get_pressed, tick_rate=60):
+        self.get_pressed = get_pressed
+        self.log = InputLog(tick_rate=tick_rate)
+        self.keys = None
+
+    def __call__(self):
+        return self.keys
+
+    def capture(self):
+        pressed = self.get_pressed()
+        mask = 0
+        for key, bit in self.log.key_bits.items():
+            if pressed[key]:
+                mask |= 1 << bit
+        self.log.masks.append(mask)
+        self.keys = self.log.keys_at(len(self.log.masks) - 1)
+
+    def record_event(self, key):
+        self.log.events.append((len(self.log.masks), key))
+
+
+class InputReplay:
+    def __init__(self, log):
+        self.log = log
+        self.tick = -1
+        self.keys = None
+
+    def __call__(self):
+        return self.keys
+
+    @property
+    def finished(self):
+        return self.tick + 1 >= self.log.ticks
+
+    def capture(self):
+        self.tick += 1
+        self.keys = self.log.keys_at(self.tick)
@@ -1,21 +1,49 @@
 # author: Paul Kim
 # date: October 9, 2022
 # version: 1.0
+import csv
+import hashlib
+import json
+import os
 import sys
-from math import sin
+import time
+import weakref
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from heapq import heappop, heappush
+from concurrent.futures import ThreadPoolExecutor
+from operator import attrgetter
 from os import walk
 
-from pygame import time
-
+from input_log import InputRecorder
+from map_format import MapData, load_map
 from world_map import *
+
+HEADLESS = os.environ.get('CAPY_HEADLESS') == '1'
+MAP_FILE = os.environ.get('CAPY_MAP')
+RECORD_FILE = os.environ.get('CAPY_RECORD')
+if HEADLESS:
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
 import pygame
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 pygame.init()
 pygame.display.set_caption("Capy Game Design 3")
 WINDOW_WIDTH, WINDOW_HEIGHT = (1200, 800)
-WINDOW = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
+WINDOW = None if HEADLESS else pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
 FPS = 60
+RENDER_FPS = 0
+MAX_CATCH_UP_TICKS = 5
 TILESIZE = 64
+ANIMATION_FPS = 9
+FLICKER_INTERVAL = 64
 BAR_HEIGHT = 20
 HP_BAR_WIDTH = 200
 MP_BAR_WIDTH = 200
@@ -29,63 +57,133 @@ TEXT_COLOR = '#EEEEEE'
 HP_COLOR = '#70e000'
 MP_COLOR = '#7b2cbf'
 UI_BORDER_ACTIVE_COLOR = 'gold'
+ASSET_CACHE_BUDGET = 128 * 1024 * 1024
+TEXT_CACHE_SIZE = 256
+PRELOAD_WORKERS = 4
+PRELOAD_FRAME_BUDGET = 0.008
+PRELOAD_FOLDERS = ['assets/player', 'assets/monster', 'assets/magic', 'assets/weapon']
+SCALED_ASSETS = [('assets/environment/rock.png', (TILESIZE, TILESIZE)),
+                 ('assets/environment/tree1.png', (TILESIZE * 2, TILESIZE * 2)),
+                 ('assets/player/down_idle/idle_down.png', (TILESIZE, TILESIZE))]
+BAKED_ASSETS_DIR = 'assets_baked'
+GAME_OVER_DELAY = 3000
+BAKE_STATIC_LAYER = False
+DIRTY_RECTS = False
+CHUNK_SIZE = 512
+CHUNK_KEEP_FRAMES = 300
+BATCH_ENEMY_AI = False
+ENEMY_ACTIVATION = True
+FLOW_FIELD_PATHING = True
+FLOW_FIELD_RADIUS = 10
+ACTIVE_REGION_MARGIN = 256
+STREAM_WORLD = False
+STREAM_CHUNK_TILES = 16
+STREAM_RADIUS = 2
+STREAM_CHUNKS_PER_FRAME = 1
+PARTICLE_POOL_SIZE = 128
+PARTICLE_FRAME_STEP = 15
+PARTICLE_FRAME_SCALE = 100
+PROFILER_HISTORY = 120
+PROFILER_TRACE_EVENTS = 100000
 
 weapon_data = {'sword': {'cooldown': 50, 'damage': 15, 'graphics': 'assets/weapon/sword/down.png'}}
 magic_data = {'heal': {'damage': 10, 'cost': 20, 'graphics': 'assets/magic/heal/3.png'},
               'dash': {'damage:': 0, 'cost': 0, 'graphics': 'assets/magic/dash/5.png'},
               'slash': {'damage': 100, 'cost': 20, 'graphics': 'assets/magic/slash/0.png'}}
 monster_data = {'mushroom': {'hp': 100, 'exp': 100, 'damage': 10, 'attack_type': 'slam', 'speed': 3, 'resistance': 1,
-                             'attack_radius': 100, 'notice_radius': 200},
+                             'attack_radius': 100, 'notice_radius': 200, 'attack_cooldown': 400},
                 'boss': {'hp': 1000, 'exp': 1000, 'damage': 20, 'attack_type': 'flame', 'speed': 3, 'resistance': 1,
-                         'attack_radius': 100, 'notice_radius': 200}}
+                         'attack_radius': 100, 'notice_radius': 200, 'attack_cooldown': 400}}
+
+
+def monster_reach():
+    return max(max(monster_info['notice_radius'], monster_info['attack_radius'])
+               for monster_info in monster_data.values())
 
 
 class World:
-    def __init__(self):
+    def __init__(self, world_map=None, bake_static=BAKE_STATIC_LAYER, dirty_rects=DIRTY_RECTS, clock=None,
+                 headless=HEADLESS, get_pressed=pygame.key.get_pressed, batch_ai=BATCH_ENEMY_AI,
+                 activation=ENEMY_ACTIVATION, streaming=STREAM_WORLD, interpolate=False, pathing=FLOW_FIELD_PATHING):
+        if world_map is None:
+            world_map = load_map(MAP_FILE) if MAP_FILE else WORLD_MAP
+        self.world_map = world_map if isinstance(world_map, MapData) else MapData.from_rows(world_map)
+        self.headless = headless
+        self.get_ticks = clock.get_ticks if clock else pygame.time.get_ticks
+        self.timers = TimerQueue()
+        self.get_pressed = get_pressed
         self.display_surface = pygame.display.get_surface()
-        self.game_paused = False
-        self.upgrade_screen = False
-        self.visible_sprites = CameraGroup()
-        self.obstacle_sprites = pygame.sprite.Group()
+        self.game_over = None
+        self.animation = Animation()
+        self.magic_animation = MagicAnimation(self.animation)
+        self.visible_sprites = CameraGroup(bake_static and not headless, dirty_rects, self.animation.particles,
+                                           interpolate)
+        self.obstacle_sprites = ObstacleGroup(self.world_map.cols, self.world_map.rows)
+        self.flow_field = FlowField(self.obstacle_sprites) if pathing else None
         self.current_attack = None
         self.attack_sprites = pygame.sprite.Group()
-        self.attackable_sprites = pygame.sprite.Group()
+        self.attackable_sprites = SpatialGroup()
+        self.enemy_batch = EnemyBatch() if batch_ai and numpy is not None else None
+        self.enemy_ai = self.enemy_batch or self.visible_sprites
+        self.activation = activation
+        reach = (monster_reach() + TILESIZE) * 2
+        self.active_region = pygame.Rect(0, 0, max(WINDOW_WIDTH + ACTIVE_REGION_MARGIN * 2, reach),
+                                         max(WINDOW_HEIGHT + ACTIVE_REGION_MARGIN * 2, reach))
+        self.awake_enemies = {}
+        self.streamer = WorldStreamer(self) if streaming else None
         self.create_map()
-        self.ui = UI()
-        self.pause_screen = PauseScreen(self.player)
-        self.upgrade_menu = UpgradeMenu(self.player)
-        self.animation = Animation()
-        self.magic_animation = MagicAnimation(self.animation)
+        if not headless:
+            self.ui = UI()
+            self.pause_screen = PauseScreen(self.player)
+            self.upgrade_menu = UpgradeMenu(self.player)
 
     def create_map(self):
-        for row_index, row in enumerate(WORLD_MAP):
-            for col_index, col in enumerate(row):
-                x = col_index * TILESIZE
-                y = row_index * TILESIZE
-                if col == 'x':
-                    Tile((x, y), [self.visible_sprites, self.obstacle_sprites], 'object')
-                if col == 't':
-                    Tile((x, y), [self.visible_sprites, self.obstacle_sprites], 'tree')
+        if self.streamer:
+            self.streamer.start()
+        else:
+            for col_index, row_index, col in self.world_map.cells():
                 if col == 'p':
-                    self.player = Player((x, y), [self.visible_sprites], self.obstacle_sprites, self.create_attack,
-                                         self.remove_attack, self.create_magic)
-                if col == 'm':
-                    monster_name = 'mushroom'
-                    Enemy(monster_name, (x, y), [self.visible_sprites, self.attackable_sprites], self.obstacle_sprites,
-                          self.damage_player, self.trigger_defeat_particles, self.add_exp)
-                if col == 'b':
-                    monster_name = 'boss'
-                    Enemy(monster_name, (x, y), [self.visible_sprites, self.attackable_sprites], self.obstacle_sprites,
-                          self.damage_player, self.trigger_defeat_particles, self.add_exp)
+                    self.create_player((col_index * TILESIZE, row_index * TILESIZE))
+                else:
+                    self.create_cell(col_index, row_index, col)
+        self.visible_sprites.sort_static()
+
+    def create_cell(self, col_index, row_index, col):
+        x = col_index * TILESIZE
+        y = row_index * TILESIZE
+        if col == 'x':
+            return Tile((x, y), [self.visible_sprites, self.obstacle_sprites], 'object')
+        if col == 't':
+            return Tile((x, y), [self.visible_sprites, self.obstacle_sprites], 'tree')
+        if col == 'm':
+            return self.create_enemy('mushroom', (x, y))
+        if col == 'b':
+            return self.create_enemy('boss', (x, y))
+
+    def create_player(self, pos):
+        self.player = Player(pos, [self.visible_sprites], self.obstacle_sprites, self.create_attack,
+                             self.remove_attack, self.create_magic, self.get_ticks, self.get_pressed, self.timers)
+
+    def create_enemy(self, monster_name, pos):
+        enemy = Enemy(monster_name, pos, self.enemy_groups(), self.obstacle_sprites,
+                      self.damage_player, self.trigger_defeat_particles, self.add_exp, self.get_ticks, self.flow_field,
+                      self.timers)
+        self.awake_enemies[enemy] = None
+        return enemy
+
+    def enemy_groups(self):
+        if self.enemy_batch is not None:
+            return [self.visible_sprites, self.attackable_sprites, self.enemy_batch]
+        return [self.visible_sprites, self.attackable_sprites]
 
     def create_attack(self):
         self.current_attack = Weapon(self.player, [self.visible_sprites, self.attack_sprites])
 
     def create_magic(self, style, damage, cost):
         if style == 'heal':
-            self.magic_animation.heal(self.player, damage, cost, [self.visible_sprites])
+            self.magic_animation.heal(self.player, damage, cost)
         if style == 'dash':
-            self.magic_animation.dash(self.player, damage, cost, [self.visible_sprites])
+            self.magic_animation.dash(self.player, damage, cost)
         if style == 'slash':
             self.magic_animation.slash(self.player, cost, [self.visible_sprites, self.attack_sprites])
 
@@ -97,145 +195,923 @@ class World:
     def player_attack_logic(self):
         if self.attack_sprites:
             for attack_sprite in self.attack_sprites:
-                collision_sprites = pygame.sprite.spritecollide(attack_sprite, self.attackable_sprites, False)
+                collision_sprites = self.attackable_sprites.sprites_in_rect(attack_sprite.rect)
                 if collision_sprites:
                     for target_sprite in collision_sprites:
                         if target_sprite.sprite_type == 'object':
                             target_sprite.kill()
                         else:
                             target_sprite.get_damage(self.player, attack_sprite.sprite_type)
+                            self.enemy_ai.track_enemy(target_sprite)
 
     def damage_player(self, amount, attack_type):
         if self.player.vulnerable:
             self.player.hp -= amount
             self.player.vulnerable = False
-            self.player.hurt_time = pygame.time.get_ticks()
-            self.animation.create_particles(attack_type, self.player.rect.center, [self.visible_sprites])
+            self.player.hurt_time = self.get_ticks()
+            self.timers.schedule(self.player.hurt_time + self.player.invulnerability_duration,
+                                 self.player.restore_vulnerability)
+            self.animation.create_particles(attack_type, self.player.rect.center)
             if self.player.hp <= -10:
-                lost_font = pygame.font.SysFont("arial", 60)
-                lost_label = lost_font.render(f"Game Over", 1, 'white')
-                WINDOW.blit(lost_label, (WINDOW_WIDTH // 2 - lost_label.get_width() // 2, 350))
-                pygame.time.wait(3000)
-                main_menu()
+                self.game_over = 'lost'
             elif self.player.exp >= 4900:
-                pygame.time.wait(3000)
-                main_menu()
+                self.game_over = 'won'
 
     def trigger_defeat_particles(self, pos, particle_type):
-        self.animation.create_particles(particle_type, pos, self.visible_sprites)
+        self.animation.create_particles(particle_type, pos)
 
     def add_exp(self, amount):
         self.player.exp += amount
 
-    def toggle_pause(self):
-        self.game_paused = not self.game_paused
-
-    def toggle_menu(self):
-        self.upgrade_screen = not self.upgrade_screen
+    def draw(self, alpha=1.0):
+        with profiler.scope('custom_draw'):
+            dirty_rects = self.visible_sprites.custom_draw(self.player, alpha)
+        with profiler.scope('ui'):
+            ui_rects = self.ui.display(self.player)
+        profiler.count('sprites drawn', self.visible_sprites.drawn_count)
+        profiler.count('particles alive', self.visible_sprites.particle_count + len(self.animation.particles.active))
+        if dirty_rects is not None:
+            dirty_rects.extend(ui_rects)
+        return dirty_rects
 
     def run(self):
-        self.visible_sprites.custom_draw(self.player)
-        self.ui.display(self.player)
-        if self.game_paused:
-            self.pause_screen.display()
-        if self.upgrade_screen:
-            self.upgrade_menu.display()
-        else:
+        dirty_rects = None if self.headless else self.draw()
+        self.step()
+        return dirty_rects
+
+    def digest(self):
+        state = hashlib.md5()
+        player = self.player
+        state.update(repr((tuple(player.hitbox), player.hp, player.mp, player.exp)).encode())
+        for sprite in self.attackable_sprites:
+            if sprite.sprite_type == 'enemy':
+                state.update(repr((sprite.monster_name, tuple(sprite.hitbox), sprite.hp)).encode())
+        return state.digest()
+
+    def teardown(self):
+        camera = self.visible_sprites
+        for sprite in reversed(camera.static_sprites + camera.dynamic_sprites):
+            sprite.kill()
+        self.animation.release()
+        camera.release()
+
+    def update_activation(self):
+        self.active_region.center = self.player.rect.center
+        awake_enemies = {sprite: None for sprite in self.attackable_sprites.sprites_in_rect(self.active_region)
+                         if sprite.sprite_type == 'enemy'}
+        for enemy in self.awake_enemies:
+            if enemy not in awake_enemies and enemy.alive():
+                enemy.sleep()
+                self.visible_sprites.set_sleeping(enemy, True)
+        for enemy in awake_enemies:
+            if enemy.sleeping:
+                enemy.wake()
+                self.visible_sprites.set_sleeping(enemy, False)
+        self.awake_enemies = awake_enemies
+        profiler.count('enemies awake', len(awake_enemies))
+
+    def step(self):
+        if self.streamer:
+            with profiler.scope('streaming'):
+                self.streamer.update(self.player)
+        if self.activation:
+            self.update_activation()
+        with profiler.scope('update'):
+            self.animation.particles.update()
             self.visible_sprites.update()
-            self.visible_sprites.enemy_update(self.player)
+            self.timers.advance(self.get_ticks())
+        with profiler.scope('enemy_update'):
+            if self.flow_field:
+                self.flow_field.update(self.player.hitbox.center)
+            self.enemy_ai.enemy_update(self.player, self.attackable_sprites)
+        with profiler.scope('player_attack_logic'):
             self.player_attack_logic()
 
 
-class CameraGroup(pygame.sprite.Group):
+class SimulationClock:
+    def __init__(self, step=1000 / FPS):
+        self.step = step
+        self.time = 0.0
+
+    def get_ticks(self):
+        return int(self.time)
+
+    def tick(self, framerate=0):
+        self.time += self.step
+        return self.step
+
+
+class TimerQueue:
     def __init__(self):
+        self.heap = []
+        self.order = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def schedule(self, due, callback):
+        heappush(self.heap, (due, self.order, callback))
+        self.order += 1
+
+    def advance(self, now):
+        heap = self.heap
+        fired = 0
+        while heap and heap[0][0] <= now:
+            heappop(heap)[2]()
+            fired += 1
+        if fired:
+            profiler.count('timers fired', fired)
+        return fired
+
+
+def simulate(world, clock, ticks):
+    for tick in range(ticks):
+        clock.tick()
+        profiler.begin_frame()
+        world.run()
+        profiler.end_frame()
+        if world.game_over:
+            return tick + 1
+    return ticks
+
+
+class WorldStreamer:
+    def __init__(self, world, chunk_tiles=STREAM_CHUNK_TILES, radius=STREAM_RADIUS,
+                 chunks_per_frame=STREAM_CHUNKS_PER_FRAME):
+        self.world = world
+        self.chunk_tiles = chunk_tiles
+        self.chunk_pixels = chunk_tiles * TILESIZE
+        self.radius = radius
+        self.chunks_per_frame = chunks_per_frame
+        self.cols = world.world_map.cols
+        self.rows = world.world_map.rows
+        self.chunk_cols = -(-self.cols // chunk_tiles)
+        self.chunk_rows = -(-self.rows // chunk_tiles)
+        self.loaded = {}
+        self.saved_enemies = {}
+        self.queue = []
+        self.heading = None
+
+    def start(self):
+        player_col, player_row = self.world.world_map.player
+        self.world.create_player((player_col * TILESIZE, player_row * TILESIZE))
+        center = self.chunk_at(self.world.player.hitbox.center)
+        for chunk in self.chunks_around(center, self.radius):
+            self.load(chunk)
+        self.heading = (center, (0, 0))
+
+    def chunk_at(self, pos):
+        return pos[0] // self.chunk_pixels, pos[1] // self.chunk_pixels
+
+    def chunks_around(self, center, radius):
+        chunks = []
+        for chunk_y in range(max(center[1] - radius, 0), min(center[1] + radius, self.chunk_rows - 1) + 1):
+            for chunk_x in range(max(center[0] - radius, 0), min(center[0] + radius, self.chunk_cols - 1) + 1):
+                chunks.append((chunk_x, chunk_y))
+        return chunks
+
+    def update(self, player):
+        center = self.chunk_at(player.hitbox.center)
+        direction = ((player.direction.x > 0) - (player.direction.x < 0),
+                     (player.direction.y > 0) - (player.direction.y < 0))
+        if (center, direction) != self.heading:
+            self.heading = (center, direction)
+            ahead = (center[0] + direction[0], center[1] + direction[1])
+            wanted = dict.fromkeys(self.chunks_around(center, self.radius) + self.chunks_around(ahead, self.radius))
+            self.queue = sorted((chunk for chunk in wanted if chunk not in self.loaded), reverse=True,
+                                key=lambda chunk: max(abs(chunk[0] - center[0]), abs(chunk[1] - center[1])))
+            for chunk in list(self.loaded):
+                if max(abs(chunk[0] - center[0]), abs(chunk[1] - center[1])) > self.radius + 1:
+                    self.unload(chunk)
+        for chunk in self.chunks_around(center, 1):
+            if chunk not in self.loaded:
+                self.load(chunk)
+        budget = self.chunks_per_frame
+        while budget and self.queue:
+            chunk = self.queue.pop()
+            if chunk not in self.loaded:
+                self.load(chunk)
+                budget -= 1
+        profiler.count('chunks loaded', len(self.loaded))
+
+    def load(self, chunk):
+        world = self.world
+        first_visit = chunk not in self.saved_enemies
+        tiles = []
+        left = chunk[0] * self.chunk_tiles
+        top = chunk[1] * self.chunk_tiles
+        for col_index, row_index, col in world.world_map.cells(left, top, left + self.chunk_tiles,
+                                                                top + self.chunk_tiles):
+            if col == 'x' or col == 't':
+                tiles.append(world.create_cell(col_index, row_index, col))
+            elif first_visit and (col == 'm' or col == 'b'):
+                world.create_cell(col_index, row_index, col)
+        for monster_name, pos, hp in self.saved_enemies.pop(chunk, ()):
+            enemy = world.create_enemy(monster_name, pos)
+            enemy.hitbox.topleft = pos
+            enemy.rect.center = enemy.hitbox.center
+            enemy.hp = hp
+            enemy.spatial_group.reindex(enemy)
+        self.loaded[chunk] = tiles
+        world.visible_sprites.sort_static()
+
+    def unload(self, chunk):
+        for tile in self.loaded.pop(chunk):
+            tile.kill()
+        chunk_rect = pygame.Rect(chunk[0] * self.chunk_pixels, chunk[1] * self.chunk_pixels,
+                                 self.chunk_pixels, self.chunk_pixels)
+        saved = []
+        for enemy in self.world.attackable_sprites.sprites_in_rect(chunk_rect):
+            if enemy.sprite_type == 'enemy' and chunk_rect.collidepoint(enemy.hitbox.center):
+                saved.append((enemy.monster_name, enemy.hitbox.topleft, enemy.hp))
+                enemy.kill()
+        self.saved_enemies[chunk] = saved
+
+
+class CameraGroup(pygame.sprite.Group):
+    def __init__(self, bake_static=False, dirty_rects=False, particles=None, interpolate=False):
         super().__init__()
         self.display_surface = pygame.display.get_surface()
-        self.half_width = self.display_surface.get_size()[0] // 2
-        self.half_height = self.display_surface.get_size()[1] // 2
+        self.half_width = WINDOW_WIDTH // 2
+        self.half_height = WINDOW_HEIGHT // 2
         self.offset = pygame.math.Vector2()
-        self.floor_surf = pygame.image.load('assets/environment/grass3.jpg').convert()
-        self.floor_surf2 = pygame.image.load('assets/environment/desert4.jpg').convert()
+        self.camera_rect = pygame.Rect(0, 0, WINDOW_WIDTH, WINDOW_HEIGHT)
+        self.drawn_count = 0
+        self.culled_count = 0
+        self.static_sprites = []
+        self.static_keys = []
+        self.static_reach = 0
+        self.static_sorted = True
+        self.dynamic_sprites = []
+        self.static_layer = StaticLayer(self) if bake_static else None
+        self.particle_count = 0
+        self.particles = particles
+        self.awake_sprites = {}
+        self.awake_sorted = True
+        self.next_update_order = 0
+        self.dirty_rects = dirty_rects
+        self.full_redraw = True
+        self.previous_camera_pos = None
+        self.screen_states = {}
+        self.interpolation = interpolate
+        self.previous_positions = {}
+        self.floor_surf = asset_cache.load('assets/environment/grass3.jpg', alpha=False)
+        self.floor_surf2 = asset_cache.load('assets/environment/desert4.jpg', alpha=False)
         self.floor_rect = self.floor_surf.get_rect(topleft=(-750, -750))
         self.floor_rect2 = self.floor_surf.get_rect(topleft=(-750, 2322))
+        self.enemy_reach = monster_reach()
+        self.active_enemies = {}
+
+    def custom_draw(self, player, alpha=1.0):
+        interpolating = self.interpolation and alpha < 1
+        player_x, player_y = self.interpolate(player, alpha) if interpolating else player.rect.center
+        self.offset.x = player_x - self.half_width
+        self.offset.y = player_y - self.half_height
+        offset_x = int(self.offset.x)
+        offset_y = int(self.offset.y)
+        self.camera_rect.topleft = (offset_x, offset_y)
+        camera_rect = self.camera_rect
+        static_sprites = [] if self.static_layer else self.static_in_rect(camera_rect)
+        self.dynamic_sprites.sort(key=attrgetter('rect.centery'))
+        dynamic_sprites = [sprite for sprite in self.dynamic_sprites if camera_rect.colliderect(sprite.rect)]
+        draw_sprites = []
+        dynamic_index = 0
+        dynamic_count = len(dynamic_sprites)
+        for sprite in static_sprites:
+            centery = sprite.rect.centery
+            while dynamic_index < dynamic_count and dynamic_sprites[dynamic_index].rect.centery < centery:
+                draw_sprites.append(dynamic_sprites[dynamic_index])
+                dynamic_index += 1
+            draw_sprites.append(sprite)
+        draw_sprites.extend(dynamic_sprites[dynamic_index:])
+        positions = {}
+        if interpolating:
+            for sprite in dynamic_sprites:
+                x, y = self.interpolate(sprite, alpha)
+                positions[sprite] = (x - sprite.rect.width // 2, y - sprite.rect.height // 2)
+            blit_sequence = [(sprite.image, (x - offset_x, y - offset_y)) for sprite, (x, y) in
+                             zip(draw_sprites, [positions.get(sprite, sprite.rect.topleft) for sprite in draw_sprites])]
+        else:
+            blit_sequence = [(sprite.image, (sprite.rect.x - offset_x, sprite.rect.y - offset_y))
+                             for sprite in draw_sprites]
+        particle_count = 0
+        if self.particles:
+            particle_count = len(self.particles.active)
+            blit_sequence.extend(self.particles.blit_sequence(camera_rect))
+        self.drawn_count = len(blit_sequence)
+        self.culled_count = len(self) + particle_count - self.drawn_count
+        if self.dirty_rects:
+            return self.draw_dirty(dynamic_sprites, blit_sequence, positions)
+        self.draw_background()
+        self.display_surface.blits(blit_sequence, False)
+        return None
+
+    def interpolate(self, sprite, alpha):
+        x, y = sprite.rect.center
+        previous = self.previous_positions.get(sprite)
+        if previous is None:
+            return x, y
+        return round(previous[0] + (x - previous[0]) * alpha), round(previous[1] + (y - previous[1]) * alpha)
+
+    def release(self):
+        asset_cache.release('assets/environment/grass3.jpg', alpha=False)
+        asset_cache.release('assets/environment/desert4.jpg', alpha=False)
+
+    def draw_background(self):
+        if self.static_layer:
+            self.static_layer.draw(self.display_surface, self.camera_rect)
+        else:
+            self.display_surface.blit(self.floor_surf, self.floor_rect.topleft - self.offset)
+            self.display_surface.blit(self.floor_surf2, self.floor_rect2.topleft - self.offset)
+
+    def draw_dirty(self, dynamic_sprites, blit_sequence, positions):
+        offset_x, offset_y = self.camera_rect.topleft
+        screen_states = {}
+        for sprite in dynamic_sprites:
+            x, y = positions.get(sprite, sprite.rect.topleft)
+            screen_states[sprite] = (pygame.Rect((x - offset_x, y - offset_y), sprite.image.get_size()), sprite.image)
+        if self.particles:
+            particle_blits = blit_sequence[len(blit_sequence) - len(self.particles.visible_slots):]
+            for slot, (image, pos) in zip(self.particles.visible_slots, particle_blits):
+                screen_states[slot] = (pygame.Rect(pos, image.get_size()), image)
+        if self.full_redraw or self.camera_rect.topleft != self.previous_camera_pos:
+            self.display_surface.fill('white')
+            self.draw_background()
+            self.display_surface.blits(blit_sequence, False)
+            dirty_rects = None
+        else:
+            dirty_rects = []
+            for sprite, (rect, image) in screen_states.items():
+                previous_state = self.screen_states.get(sprite)
+                if previous_state is None:
+                    dirty_rects.append(rect)
+                elif previous_state[1] is not image or previous_state[0] != rect:
+                    dirty_rects.append(previous_state[0].union(rect))
+            for sprite, (rect, image) in self.screen_states.items():
+                if sprite not in screen_states:
+                    dirty_rects.append(rect)
+            if dirty_rects:
+                screen_rects = [pygame.Rect(pos, image.get_size()) for image, pos in blit_sequence]
+                for dirty_rect in dirty_rects:
+                    self.display_surface.set_clip(dirty_rect)
+                    self.display_surface.fill('white')
+                    self.draw_background()
+                    self.display_surface.blits([blit_sequence[index] for index in
+                                                dirty_rect.collidelistall(screen_rects)], False)
+                self.display_surface.set_clip(None)
+        self.screen_states = screen_states
+        self.previous_camera_pos = self.camera_rect.topleft
+        self.full_redraw = False
+        return dirty_rects
+
+    def static_in_rect(self, rect):
+        if not self.static_sorted:
+            self.sort_static()
+        start = bisect_left(self.static_keys, rect.top - self.static_reach)
+        end = bisect_right(self.static_keys, rect.bottom + self.static_reach)
+        return [sprite for sprite in self.static_sprites[start:end] if rect.colliderect(sprite.rect)]
+
+    def add_internal(self, sprite, layer=None):
+        super().add_internal(sprite, layer)
+        if isinstance(sprite, Tile):
+            if self.static_layer:
+                self.static_layer.invalidate(sprite.rect)
+            self.static_reach = max(self.static_reach, sprite.rect.height // 2 + 1)
+            if self.static_keys and sprite.rect.centery < self.static_keys[-1]:
+                self.static_sorted = False
+            self.static_sprites.append(sprite)
+            self.static_keys.append(sprite.rect.centery)
+        else:
+            self.dynamic_sprites.append(sprite)
+            self.awake_sprites[sprite] = None
+            sprite.update_order = self.next_update_order
+            self.next_update_order += 1
+            if isinstance(sprite, ParticleEffect):
+                self.particle_count += 1
+
+    def remove_internal(self, sprite):
+        super().remove_internal(sprite)
+        if isinstance(sprite, Tile):
+            if self.static_layer:
+                self.static_layer.invalidate(sprite.rect)
+            start = bisect_left(self.static_keys, sprite.rect.centery) if self.static_sorted else 0
+            index = self.static_sprites.index(sprite, start)
+            del self.static_sprites[index]
+            del self.static_keys[index]
+        else:
+            self.dynamic_sprites.remove(sprite)
+            self.awake_sprites.pop(sprite, None)
+            self.previous_positions.pop(sprite, None)
+            if isinstance(sprite, ParticleEffect):
+                self.particle_count -= 1
+
+    def update(self, *args, **kwargs):
+        if not self.awake_sorted:
+            self.awake_sprites = dict.fromkeys(sorted(self.awake_sprites, key=attrgetter('update_order')))
+            self.awake_sorted = True
+        awake_sprites = list(self.awake_sprites)
+        if self.interpolation:
+            self.previous_positions.update((sprite, sprite.rect.center) for sprite in awake_sprites)
+        for sprite in awake_sprites:
+            sprite.update(*args, **kwargs)
+
+    def set_sleeping(self, sprite, sleeping):
+        if sleeping:
+            self.awake_sprites.pop(sprite, None)
+            if sprite in self.previous_positions:
+                self.previous_positions[sprite] = sprite.rect.center
+        elif sprite in self.dynamic_sprites:
+            self.awake_sprites[sprite] = None
+            self.awake_sorted = False
+
+    def sort_static(self):
+        if self.static_sorted:
+            return
+        self.static_sprites.sort(key=attrgetter('rect.centery'))
+        self.static_keys = [sprite.rect.centery for sprite in self.static_sprites]
+        self.static_sorted = True
+
+    def enemy_update(self, player, enemy_sprites):
+        nearby_enemies = {sprite: None for sprite in
+                          enemy_sprites.sprites_in_radius(player.rect.center, self.enemy_reach)
+                          if sprite.sprite_type == 'enemy'}
+        for enemy in self.active_enemies:
+            if enemy.alive():
+                nearby_enemies[enemy] = None
+        self.active_enemies = {}
+        for enemy in sorted(nearby_enemies, key=lambda sprite: sprite.spatial_order):
+            enemy.enemy_update(player)
+            if enemy.status != 'idle':
+                self.active_enemies[enemy] = None
 
-    def custom_draw(self, player):
-        self.offset.x = player.rect.centerx - self.half_width
-        self.offset.y = player.rect.centery - self.half_height
-        floor_offset_pos = self.floor_rect.topleft - self.offset
-        floor_offset_pos2 = self.floor_rect2.topleft - self.offset
-        self.display_surface.blit(self.floor_surf, floor_offset_pos)
-        self.display_surface.blit(self.floor_surf2, floor_offset_pos2)
-        for sprite in sorted(self.sprites(), key=lambda sprite: sprite.rect.centery):
-            offset_pos = sprite.rect.topleft - self.offset
-            self.display_surface.blit(sprite.image, offset_pos)
+    def track_enemy(self, enemy):
+        self.active_enemies[enemy] = None
 
-    def enemy_update(self, player):
-        enemy_sprites = [sprite for sprite in self.sprites() if
-                         hasattr(sprite, 'sprite_type') and sprite.sprite_type == 'enemy']
-        for enemy in enemy_sprites:
-            enemy.enemy_update(player)
+
+class EnemyBatch(pygame.sprite.Group):
+    def __init__(self, capacity=64):
+        super().__init__()
+        self.enemies = []
+        self.pending = []
+        self.next_order = 0
+        self.capacity = 0
+        self.allocate(capacity)
+
+    def allocate(self, capacity):
+        count = len(self.enemies)
+        buffers = {'positions': numpy.zeros((capacity, 2)), 'attack_radius': numpy.zeros(capacity),
+                   'notice_radius': numpy.zeros(capacity), 'can_attack': numpy.ones(capacity, bool),
+                   'status': numpy.zeros(capacity, numpy.int8), 'hit': numpy.zeros(capacity, bool),
+                   'order': numpy.zeros(capacity, numpy.int64)}
+        for name, buffer in buffers.items():
+            if self.capacity:
+                buffer[:count] = getattr(self, name)[:count]
+            setattr(self, name, buffer)
+        self.capacity = capacity
+
+    def add_internal(self, sprite, layer=None):
+        super().add_internal(sprite, layer)
+        if len(self.enemies) == self.capacity:
+            self.allocate(self.capacity * 2)
+        index = len(self.enemies)
+        sprite.batch_index = index
+        self.enemies.append(sprite)
+        self.order[index] = self.next_order
+        self.status[index] = 0
+        self.hit[index] = False
+        self.next_order += 1
+        self.pending.append(sprite)
+
+    def remove_internal(self, sprite):
+        super().remove_internal(sprite)
+        index = sprite.batch_index
+        last = self.enemies.pop()
+        if last is not sprite:
+            self.enemies[index] = last
+            last.batch_index = index
+            last_index = len(self.enemies)
+            for buffer in (self.positions, self.attack_radius, self.notice_radius, self.can_attack, self.status,
+                           self.hit, self.order):
+                buffer[index] = buffer[last_index]
+        if sprite in self.pending:
+            self.pending.remove(sprite)
+
+    def track_enemy(self, enemy):
+        if enemy.alive():
+            self.hit[enemy.batch_index] = True
+
+    def enemy_update(self, player, enemy_sprites=None):
+        for enemy in self.pending:
+            self.attack_radius[enemy.batch_index] = enemy.attack_radius
+            self.notice_radius[enemy.batch_index] = enemy.notice_radius
+        self.pending = []
+        count = len(self.enemies)
+        if not count:
+            return
+        enemies = self.enemies
+        positions = self.positions[:count]
+        positions[:] = [enemy.rect.center for enemy in enemies]
+        can_attack = self.can_attack[:count]
+        can_attack[:] = [enemy.can_attack for enemy in enemies]
+        delta = numpy.array(player.rect.center, dtype=float) - positions
+        distance = numpy.sqrt(delta[:, 0] * delta[:, 0] + delta[:, 1] * delta[:, 1])
+        attacking = (distance <= self.attack_radius[:count]) & can_attack
+        moving = ~attacking & (distance <= self.notice_radius[:count])
+        status = numpy.where(attacking, 2, numpy.where(moving, 1, 0)).astype(numpy.int8)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            direction = numpy.where(distance[:, None] > 0, delta / distance[:, None], 0.0)
+        touched = numpy.flatnonzero((status != 0) | (self.status[:count] != 0) | self.hit[:count])
+        touched = touched[numpy.argsort(self.order[touched])]
+        for index in touched.tolist():
+            enemy = enemies[index]
+            if status[index] == 2:
+                if enemy.status != 'attack':
+                    enemy.animation_start = enemy.get_ticks()
+                enemy.status = 'attack'
+                enemy.attack_time = enemy.get_ticks()
+                enemy.damage_player(enemy.attack_damage, enemy.attack_type)
+            elif status[index] == 1:
+                enemy.status = 'move'
+                flow_direction = enemy.flow_field.direction(enemy.hitbox.center) if enemy.flow_field else None
+                if flow_direction is not None:
+                    enemy.direction = flow_direction
+                else:
+                    enemy.direction = pygame.math.Vector2(direction[index, 0], direction[index, 1])
+            else:
+                enemy.status = 'idle'
+                enemy.direction = pygame.math.Vector2()
+        self.status[:count] = status
+        self.hit[:count] = False
+
+
+class StaticLayer:
+    def __init__(self, camera, chunk_size=CHUNK_SIZE, keep_frames=CHUNK_KEEP_FRAMES):
+        self.camera = camera
+        self.chunk_size = chunk_size
+        self.keep_frames = keep_frames
+        self.chunks = {}
+        self.last_drawn = {}
+        self.frame = 0
+        self.baked_count = 0
+
+    def chunk_range(self, rect):
+        return (rect.left // self.chunk_size, rect.top // self.chunk_size,
+                (rect.right - 1) // self.chunk_size, (rect.bottom - 1) // self.chunk_size)
+
+    def bake(self, chunk_x, chunk_y):
+        chunk_rect = pygame.Rect(chunk_x * self.chunk_size, chunk_y * self.chunk_size, self.chunk_size,
+                                 self.chunk_size)
+        surface = pygame.Surface(chunk_rect.size).convert()
+        surface.fill('white')
+        camera = self.camera
+        surface.blit(camera.floor_surf, (camera.floor_rect.x - chunk_rect.x, camera.floor_rect.y - chunk_rect.y))
+        surface.blit(camera.floor_surf2, (camera.floor_rect2.x - chunk_rect.x, camera.floor_rect2.y - chunk_rect.y))
+        surface.blits([(sprite.image, (sprite.rect.x - chunk_rect.x, sprite.rect.y - chunk_rect.y))
+                       for sprite in camera.static_in_rect(chunk_rect)], False)
+        self.baked_count += 1
+        return surface
+
+    def draw(self, display_surface, camera_rect):
+        self.frame += 1
+        left, top, right, bottom = self.chunk_range(camera_rect)
+        blit_sequence = []
+        for chunk_y in range(top, bottom + 1):
+            for chunk_x in range(left, right + 1):
+                chunk = self.chunks.get((chunk_x, chunk_y))
+                if chunk is None:
+                    chunk = self.chunks[(chunk_x, chunk_y)] = self.bake(chunk_x, chunk_y)
+                self.last_drawn[(chunk_x, chunk_y)] = self.frame
+                blit_sequence.append((chunk, (chunk_x * self.chunk_size - camera_rect.x,
+                                              chunk_y * self.chunk_size - camera_rect.y)))
+        display_surface.blits(blit_sequence, False)
+        if self.frame % self.keep_frames == 0:
+            self.evict()
+
+    def evict(self):
+        for chunk, last_drawn in list(self.last_drawn.items()):
+            if self.frame - last_drawn > self.keep_frames:
+                del self.chunks[chunk]
+                del self.last_drawn[chunk]
+
+    def invalidate(self, rect):
+        if not self.chunks:
+            return
+        left, top, right, bottom = self.chunk_range(rect)
+        for chunk_y in range(top, bottom + 1):
+            for chunk_x in range(left, right + 1):
+                if self.chunks.pop((chunk_x, chunk_y), None) is not None:
+                    del self.last_drawn[(chunk_x, chunk_y)]
+
+
+class SpatialGroup(pygame.sprite.Group):
+    def __init__(self, cell_size=TILESIZE * 2):
+        super().__init__()
+        self.cell_size = cell_size
+        self.buckets = {}
+        self.sprite_cells = {}
+        self.next_order = 0
+
+    def add_internal(self, sprite, layer=None):
+        super().add_internal(sprite, layer)
+        sprite.spatial_group = self
+        sprite.spatial_order = self.next_order
+        self.next_order += 1
+        if hasattr(sprite, 'rect'):
+            self.reindex(sprite)
+
+    def remove_internal(self, sprite):
+        super().remove_internal(sprite)
+        sprite.spatial_group = None
+        cells = self.sprite_cells.pop(sprite, None)
+        if cells:
+            self.unlink(sprite, cells)
+
+    def cell_range(self, rect):
+        return (rect.left // self.cell_size, rect.top // self.cell_size,
+                (rect.right - 1) // self.cell_size, (rect.bottom - 1) // self.cell_size)
+
+    def reindex(self, sprite):
+        cells = self.cell_range(sprite.rect)
+        old_cells = self.sprite_cells.get(sprite)
+        if cells == old_cells:
+            return
+        if old_cells:
+            self.unlink(sprite, old_cells)
+        self.sprite_cells[sprite] = cells
+        left, top, right, bottom = cells
+        for cell_y in range(top, bottom + 1):
+            for cell_x in range(left, right + 1):
+                bucket = self.buckets.get((cell_x, cell_y))
+                if bucket is None:
+                    bucket = self.buckets[(cell_x, cell_y)] = {}
+                bucket[sprite] = None
+
+    def unlink(self, sprite, cells):
+        left, top, right, bottom = cells
+        for cell_y in range(top, bottom + 1):
+            for cell_x in range(left, right + 1):
+                bucket = self.buckets[(cell_x, cell_y)]
+                del bucket[sprite]
+                if not bucket:
+                    del self.buckets[(cell_x, cell_y)]
+
+    def candidates(self, rect):
+        left, top, right, bottom = self.cell_range(rect)
+        found = {}
+        for cell_y in range(top, bottom + 1):
+            for cell_x in range(left, right + 1):
+                bucket = self.buckets.get((cell_x, cell_y))
+                if bucket:
+                    found.update(bucket)
+        return found
+
+    def sprites_in_rect(self, rect):
+        sprites = [sprite for sprite in self.candidates(rect) if sprite.rect.colliderect(rect)]
+        sprites.sort(key=lambda sprite: sprite.spatial_order)
+        return sprites
+
+    def sprites_in_radius(self, center, radius):
+        area = pygame.Rect(0, 0, radius * 2 + 1, radius * 2 + 1)
+        area.center = center
+        center_x, center_y = center
+        radius_squared = radius * radius
+        sprites = []
+        for sprite in self.candidates(area):
+            sprite_x, sprite_y = sprite.rect.center
+            if (sprite_x - center_x) ** 2 + (sprite_y - center_y) ** 2 <= radius_squared:
+                sprites.append(sprite)
+        return sprites
+
+
+class ObstacleGroup(pygame.sprite.Group):
+    def __init__(self, cols, rows, cell_size=TILESIZE):
+        super().__init__()
+        self.cols = cols
+        self.rows = rows
+        self.cell_size = cell_size
+        self.cells = bytearray(cols * rows)
+        self.cell_sprites = {}
+        self.outside_sprites = []
+        self.next_order = 0
+        self.version = 0
+
+    def cell_range(self, rect):
+        left = rect.left // self.cell_size
+        right = (rect.right - 1) // self.cell_size
+        top = rect.top // self.cell_size
+        bottom = (rect.bottom - 1) // self.cell_size
+        return left, right, top, bottom
+
+    def add_internal(self, sprite, layer=None):
+        super().add_internal(sprite, layer)
+        sprite.obstacle_order = self.next_order
+        self.next_order += 1
+        self.version += 1
+        left, right, top, bottom = self.cell_range(sprite.hitbox)
+        if left < 0 or top < 0 or right >= self.cols or bottom >= self.rows:
+            self.outside_sprites.append(sprite)
+        for row in range(max(top, 0), min(bottom, self.rows - 1) + 1):
+            for col in range(max(left, 0), min(right, self.cols - 1) + 1):
+                index = row * self.cols + col
+                sprites = self.cell_sprites.get(index)
+                if sprites is None:
+                    sprites = self.cell_sprites[index] = []
+                sprites.append(sprite)
+                self.cells[index] = min(len(sprites), 255)
+
+    def remove_internal(self, sprite):
+        super().remove_internal(sprite)
+        self.version += 1
+        if sprite in self.outside_sprites:
+            self.outside_sprites.remove(sprite)
+        left, right, top, bottom = self.cell_range(sprite.hitbox)
+        for row in range(max(top, 0), min(bottom, self.rows - 1) + 1):
+            for col in range(max(left, 0), min(right, self.cols - 1) + 1):
+                index = row * self.cols + col
+                sprites = self.cell_sprites.get(index)
+                if sprites and sprite in sprites:
+                    sprites.remove(sprite)
+                    self.cells[index] = min(len(sprites), 255)
+                    if not sprites:
+                        del self.cell_sprites[index]
+
+    def nearby(self, rect):
+        left, right, top, bottom = self.cell_range(rect)
+        left = max(left, 0)
+        right = min(right, self.cols - 1)
+        nearby = []
+        for row in range(max(top, 0), min(bottom, self.rows - 1) + 1):
+            base = row * self.cols
+            for index in range(base + left, base + right + 1):
+                if self.cells[index]:
+                    for sprite in self.cell_sprites[index]:
+                        if sprite not in nearby:
+                            nearby.append(sprite)
+        nearby.extend(self.outside_sprites)
+        if len(nearby) > 1:
+            nearby.sort(key=lambda sprite: sprite.obstacle_order)
+        return nearby
+
+
+class FlowField:
+    def __init__(self, obstacles, radius=FLOW_FIELD_RADIUS):
+        self.obstacles = obstacles
+        self.radius = radius
+        self.width = radius * 2 + 3
+        self.unvisited = array('i', [-1]) * (self.width * self.width)
+        self.parents = self.unvisited
+        self.start = (radius + 1) * self.width + radius + 1
+        width = self.width
+        self.moves = [(-width, 0, 0), (width, 0, 0), (-1, 0, 0), (1, 0, 0), (-width - 1, -width, -1),
+                      (-width + 1, -width, 1), (width - 1, width, -1), (width + 1, width, 1)]
+        self.origin = None
+        self.version = None
+        self.left = 0
+        self.top = 0
+
+    def update(self, pos):
+        origin = (pos[0] // TILESIZE, pos[1] // TILESIZE)
+        if origin == self.origin and self.version == self.obstacles.version:
+            return
+        self.origin = origin
+        self.version = self.obstacles.version
+        self.left = origin[0] - self.radius - 1
+        self.top = origin[1] - self.radius - 1
+        blocked = self.blocked_cells()
+        parents = array('i', self.unvisited)
+        parents[self.start] = self.start
+        frontier = deque([self.start])
+        moves = self.moves
+        while frontier:
+            index = frontier.popleft()
+            for offset, side_a, side_b in moves:
+                neighbour = index + offset
+                if parents[neighbour] < 0 and not blocked[neighbour]:
+                    if side_a and (blocked[index + side_a] or blocked[index + side_b]):
+                        continue
+                    parents[neighbour] = index
+                    frontier.append(neighbour)
+        self.parents = parents
+        profiler.count('flow field rebuilds')
+
+    def blocked_cells(self):
+        obstacles = self.obstacles
+        width = self.width
+        blocked = bytearray(b'\1' * (width * width))
+        left = max(self.left + 1, 0)
+        right = min(self.left + width - 1, obstacles.cols)
+        for row in range(max(self.top + 1, 0), min(self.top + width - 1, obstacles.rows)):
+            start = row * obstacles.cols
+            offset = (row - self.top) * width - self.left
+            blocked[offset + left:offset + right] = obstacles.cells[start + left:start + right]
+        return blocked
+
+    def direction(self, pos):
+        col = pos[0] // TILESIZE - self.left
+        row = pos[1] // TILESIZE - self.top
+        if not (0 <= col < self.width and 0 <= row < self.width):
+            return None
+        step = self.parents[row * self.width + col]
+        if step < 0 or step == self.start:
+            return None
+        target_row, target_col = divmod(step, self.width)
+        direction = pygame.math.Vector2((self.left + target_col) * TILESIZE + TILESIZE // 2 - pos[0],
+                                        (self.top + target_row) * TILESIZE + TILESIZE // 2 - pos[1])
+        return direction.normalize() if direction.length_squared() else None
 
 
 class Tile(pygame.sprite.Sprite):
     def __init__(self, pos, groups, sprite_type):
-        super().__init__(groups)
         self.sprite_type = sprite_type
         if sprite_type == 'object':
-            self.image = pygame.transform.scale(pygame.image.load('assets/environment/rock.png').convert_alpha(),
-                                                (TILESIZE, TILESIZE))
+            self.asset = ('assets/environment/rock.png', (TILESIZE, TILESIZE))
         if sprite_type == 'tree':
-            self.image = pygame.transform.scale(pygame.image.load('assets/environment/tree1.png').convert_alpha(),
-                                                (TILESIZE * 2, TILESIZE * 2))
+            self.asset = ('assets/environment/tree1.png', (TILESIZE * 2, TILESIZE * 2))
+        self.image = asset_cache.load(*self.asset)
 
         self.rect = self.image.get_rect(topleft=pos)
         self.hitbox = self.rect.inflate(0, -10)
+        super().__init__(groups)
+
+    def kill(self):
+        if self.alive():
+            asset_cache.release(*self.asset)
+        super().kill()
+
+
+class AnimationClip:
+    def __init__(self, frames, flash_alpha=0):
+        self.frames = frames
+        self.flash_frames = []
+        for frame in frames:
+            flash_frame = frame.copy()
+            flash_frame.set_alpha(flash_alpha)
+            self.flash_frames.append(flash_frame)
+        self.length = len(frames)
+        self.duration = -(-self.length * 1000 // ANIMATION_FPS)
+
+    def __len__(self):
+        return self.length
+
+    def frame(self, elapsed, flash=False):
+        index = elapsed * ANIMATION_FPS // 1000 % self.length
+        return self.flash_frames[index] if flash else self.frames[index]
 
 
 class Entity(pygame.sprite.Sprite):
-    def __init__(self, groups):
+    spatial_group = None
+
+    def __init__(self, groups, get_ticks=pygame.time.get_ticks, timers=None):
         super().__init__(groups)
-        self.frame_index = 0
-        self.animation_speed = 0.15
+        self.get_ticks = get_ticks
+        self.timers = timers if timers is not None else TimerQueue()
+        self.animation_start = get_ticks()
         self.direction = pygame.math.Vector2()
 
     def move(self, speed):
-        if self.direction.magnitude() != 0:
+        if self.direction.x or self.direction.y:
             self.direction = self.direction.normalize()
-        self.hitbox.x += self.direction.x * speed
-        self.collision('horizontal')
-        self.hitbox.y += self.direction.y * speed
-        self.collision('vertical')
-        self.rect.center = self.hitbox.center
+            self.hitbox.x += self.direction.x * speed
+            self.collision('horizontal')
+            self.hitbox.y += self.direction.y * speed
+            self.collision('vertical')
+            self.rect.center = self.hitbox.center
+        if self.spatial_group is not None:
+            self.spatial_group.reindex(self)
 
     def collision(self, direction):
+        obstacles = self.obstacle_sprites.nearby(self.hitbox)
+        profiler.count('collisions tested', len(obstacles))
         if direction == 'horizontal':
-            for sprite in self.obstacle_sprites:
+            for sprite in obstacles:
                 if sprite.hitbox.colliderect(self.hitbox):
                     if self.direction.x > 0:
                         self.hitbox.right = sprite.hitbox.left
                     if self.direction.x < 0:
                         self.hitbox.left = sprite.hitbox.right
         if direction == 'vertical':
-            for sprite in self.obstacle_sprites:
+            for sprite in obstacles:
                 if sprite.hitbox.colliderect(self.hitbox):
                     if self.direction.y > 0:
                         self.hitbox.bottom = sprite.hitbox.top
                     if self.direction.y < 0:
                         self.hitbox.top = sprite.hitbox.bottom
 
-    def wave_value(self):
-        value = sin(pygame.time.get_ticks())
-        if value >= 0:
-            return 255
-        else:
-            return 0
+    def flicker(self):
+        return self.get_ticks() // FLICKER_INTERVAL % 2 == 1
+
+    def set_image(self, image):
+        if image is not self.image:
+            self.image = image
+            self.rect = image.get_rect(center=self.hitbox.center)
 
 
 class Player(Entity):
-    def __init__(self, pos, groups, obstacle_sprites, create_attack, remove_attack, create_magic):
-        super().__init__(groups)
-        self.image = pygame.transform.scale(pygame.image.load('assets/player/down_idle/idle_down.png').convert_alpha(),
-                                            (TILESIZE, TILESIZE))
+    def __init__(self, pos, groups, obstacle_sprites, create_attack, remove_attack, create_magic,
+                 get_ticks=pygame.time.get_ticks, get_pressed=pygame.key.get_pressed, timers=None):
+        super().__init__(groups, get_ticks, timers)
+        self.get_pressed = get_pressed
+        self.image = asset_cache.load('assets/player/down_idle/idle_down.png', (TILESIZE, TILESIZE))
         self.rect = self.image.get_rect(topleft=pos)
         self.hitbox = self.rect.inflate(0, -26)
         self.initiate_player_assets()
@@ -270,11 +1146,17 @@ class Player(Entity):
                            'right_idle': [], 'up_attack': [], 'down_attack': [], 'left_attack': [], 'right_attack': []}
         for animation in self.animations.keys():
             full_path = character_path + animation
-            self.animations[animation] = import_folder(full_path)
-        print(self.animations)
+            self.animations[animation] = asset_cache.load_clip(full_path)
+
+    def kill(self):
+        if self.alive():
+            asset_cache.release('assets/player/down_idle/idle_down.png', (TILESIZE, TILESIZE))
+            for animation in self.animations.keys():
+                asset_cache.release_folder('assets/player/' + animation)
+        super().kill()
 
     def user_input(self):
-        keys = pygame.key.get_pressed()
+        keys = self.get_pressed()
         if keys[pygame.K_UP]:
             self.direction.y = -1
             self.status = 'up'
@@ -293,19 +1175,16 @@ class Player(Entity):
         else:
             self.direction.x = 0
         if keys[pygame.K_q] and not self.attacking:
-            self.attacking = True
-            self.attack_time = pygame.time.get_ticks()
+            self.start_attack()
             self.create_attack()
         if keys[pygame.K_w] and not self.attacking:
-            self.attacking = True
-            self.attack_time = pygame.time.get_ticks()
+            self.start_attack()
             style = list(magic_data.keys())[self.magic_index]
             damage = list(magic_data.values())[self.magic_index]['damage'] + self.stats['magic']
             cost = list(magic_data.values())[self.magic_index]['cost']
             self.create_magic(style, damage, cost)
         if keys[pygame.K_e] and not self.attacking:
-            self.attacking = True
-            self.attack_time = pygame.time.get_ticks()
+            self.start_attack()
             style = list(magic_data.keys())[2]
             damage = list(magic_data.values())[2]['damage'] + self.stats['magic']
             cost = list(magic_data.values())[2]['cost']
@@ -313,7 +1192,8 @@ class Player(Entity):
 
         if keys[pygame.K_SPACE] and not self.dashing:
             self.dashing = True
-            self.dash_time = pygame.time.get_ticks()
+            self.dash_time = self.get_ticks()
+            self.timers.schedule(self.dash_time + self.dash_cooldown, self.finish_dash)
             self.dash()
             style = list(magic_data.keys())[1]
             damage = list(magic_data.values())[self.magic_index]['damage'] + self.stats['magic']
@@ -337,17 +1217,8 @@ class Player(Entity):
                 self.status = self.status.replace('_attack', '')
 
     def animate(self):
-        animation = self.animations[self.status]
-        self.frame_index += self.animation_speed
-        if self.frame_index >= len(animation):
-            self.frame_index = 0
-        self.image = animation[int(self.frame_index)]
-        self.rect = self.image.get_rect(center=self.hitbox.center)
-        if not self.vulnerable:
-            alpha = self.wave_value()
-            self.image.set_alpha(alpha)
-        else:
-            self.image.set_alpha(255)
+        elapsed = self.get_ticks() - self.animation_start
+        self.set_image(self.animations[self.status].frame(elapsed, not self.vulnerable and self.flicker()))
 
     def get_full_weapon_damage(self):
         base_damage = self.stats['attack']
@@ -365,19 +1236,22 @@ class Player(Entity):
     def remove_dash(self):
         self.speed -= 5
 
-    def cooldowns(self):
-        current_time = pygame.time.get_ticks()
-        if self.attacking:
-            if current_time - self.attack_time >= self.attack_cooldown + weapon_data[self.weapon]['cooldown']:
-                self.attacking = False
-                self.remove_attack()
-        if not self.vulnerable:
-            if current_time - self.hurt_time >= self.invulnerability_duration:
-                self.vulnerable = True
-        if self.dashing:
-            if current_time - self.dash_time >= self.dash_cooldown:
-                self.dashing = False
-                self.remove_dash()
+    def start_attack(self):
+        self.attacking = True
+        self.attack_time = self.get_ticks()
+        self.timers.schedule(self.attack_time + self.attack_cooldown + weapon_data[self.weapon]['cooldown'],
+                             self.finish_attack)
+
+    def finish_attack(self):
+        self.attacking = False
+        self.remove_attack()
+
+    def finish_dash(self):
+        self.dashing = False
+        self.remove_dash()
+
+    def restore_vulnerability(self):
+        self.vulnerable = True
 
     def mp_recovery(self):
         if self.mp < self.stats['mp']:
@@ -387,7 +1261,6 @@ class Player(Entity):
 
     def update(self):
         self.user_input()
-        self.cooldowns()
         self.get_status()
         self.move(self.speed)
         self.mp_recovery()
@@ -395,15 +1268,17 @@ class Player(Entity):
 
 
 class Enemy(Entity):
-    def __init__(self, monster_name, pos, groups, obstacle_sprites, damage_player, trigger_defeat_particles, add_exp):
-        super().__init__(groups)
+    def __init__(self, monster_name, pos, groups, obstacle_sprites, damage_player, trigger_defeat_particles, add_exp,
+                 get_ticks=pygame.time.get_ticks, flow_field=None, timers=None):
+        super().__init__(groups, get_ticks, timers)
         self.sprite_type = 'enemy'
         self.import_graphics(monster_name)
         self.status = 'idle'
-        self.image = self.animations[self.status][self.frame_index]
+        self.image = self.animations[self.status].frames[0]
         self.rect = self.image.get_rect(topleft=pos)
         self.hitbox = self.rect.inflate(0, -10)
         self.obstacle_sprites = obstacle_sprites
+        self.flow_field = flow_field
         self.vulnerable = True
         self.hit_time = None
         self.invincibility_duration = 200
@@ -419,31 +1294,36 @@ class Enemy(Entity):
         self.exp = monster_info['exp']
         self.can_attack = True
         self.attack_time = None
-        self.attack_cooldown = 400
+        self.attack_cooldown = monster_info['attack_cooldown']
+        self.sleeping = False
         self.damage_player = damage_player
         self.trigger_defeat_particles = trigger_defeat_particles
         self.add_exp = add_exp
+        if self.spatial_group is not None:
+            self.spatial_group.reindex(self)
 
     def import_graphics(self, name):
         self.animations = {'idle': [], 'move': [], 'attack': []}
         main_path = f'assets/monster/{name}/'
         for animation in self.animations.keys():
-            self.animations[animation] = import_folder(main_path + animation)
+            self.animations[animation] = asset_cache.load_clip(main_path + animation)
+
+    def kill(self):
+        if self.alive():
+            for animation in self.animations.keys():
+                asset_cache.release_folder(f'assets/monster/{self.monster_name}/{animation}')
+        super().kill()
 
     def animate(self):
-        animation = self.animations[self.status]
-        self.frame_index += self.animation_speed
-        if self.frame_index >= len(animation):
-            if self.status == 'attack':
+        clip = self.animations[self.status]
+        elapsed = self.get_ticks() - self.animation_start
+        if self.status == 'attack' and elapsed >= clip.duration:
+            if self.can_attack:
                 self.can_attack = False
-            self.frame_index = 0
-        self.image = animation[int(self.frame_index)]
-        self.rect = self.image.get_rect(center=self.hitbox.center)
-        if not self.vulnerable:
-            alpha = self.wave_value()
-            self.image.set_alpha(alpha)
-        else:
-            self.image.set_alpha(255)
+                self.timers.schedule(self.attack_time + self.attack_cooldown, self.reset_attack)
+            self.animation_start = self.get_ticks()
+            elapsed = 0
+        self.set_image(clip.frame(elapsed, not self.vulnerable and self.flicker()))
 
     def get_player_distance_direction(self, player):
         enemy_vector = pygame.math.Vector2(self.rect.center)
@@ -459,7 +1339,7 @@ class Enemy(Entity):
         distance = self.get_player_distance_direction(player)[0]
         if distance <= self.attack_radius and self.can_attack:
             if self.status != 'attack':
-                self.frame_index = 0
+                self.animation_start = self.get_ticks()
             self.status = 'attack'
         elif distance <= self.notice_radius:
             self.status = 'move'
@@ -468,21 +1348,19 @@ class Enemy(Entity):
 
     def actions(self, player):
         if self.status == 'attack':
-            self.attack_time = pygame.time.get_ticks()
+            self.attack_time = self.get_ticks()
             self.damage_player(self.attack_damage, self.attack_type)
         elif self.status == 'move':
-            self.direction = self.get_player_distance_direction(player)[1]
+            direction = self.flow_field.direction(self.hitbox.center) if self.flow_field else None
+            self.direction = direction if direction is not None else self.get_player_distance_direction(player)[1]
         else:
             self.direction = pygame.math.Vector2()
 
-    def cooldown(self):
-        current_time = pygame.time.get_ticks()
-        if not self.can_attack:
-            if current_time - self.attack_time >= self.attack_cooldown:
-                self.can_attack = True
-        if not self.vulnerable:
-            if current_time - self.hit_time >= self.invincibility_duration:
-                self.vulnerable = True
+    def reset_attack(self):
+        self.can_attack = True
+
+    def restore_vulnerability(self):
+        self.vulnerable = True
 
     def get_damage(self, player, attack_type):
         self.direction = self.get_player_distance_direction(player)[1]
@@ -491,8 +1369,9 @@ class Enemy(Entity):
                 self.hp -= player.get_full_weapon_damage()
             else:
                 self.hp -= player.get_full_magic_damage()
-            self.hit_time = pygame.time.get_ticks()
+            self.hit_time = self.get_ticks()
             self.vulnerable = False
+            self.timers.schedule(self.hit_time + self.invincibility_duration, self.restore_vulnerability)
 
     def hit_reaction(self):
         if not self.vulnerable:
@@ -504,11 +1383,16 @@ class Enemy(Entity):
             self.trigger_defeat_particles(self.rect.center, self.monster_name)
             self.add_exp(self.exp)
 
+    def sleep(self):
+        self.sleeping = True
+
+    def wake(self):
+        self.sleeping = False
+
     def update(self):
         self.hit_reaction()
         self.animate()
         self.move(self.speed)
-        self.cooldown()
         self.check_death()
 
     def enemy_update(self, player):
@@ -521,8 +1405,8 @@ class Weapon(pygame.sprite.Sprite):
         super().__init__(groups)
         self.sprite_type = 'weapon'
         direction = player.status.split('_')[0]
-        full_path = f'assets/weapon/{player.weapon}/{direction}.png'
-        self.image = pygame.image.load(full_path).convert_alpha()
+        self.full_path = f'assets/weapon/{player.weapon}/{direction}.png'
+        self.image = asset_cache.load(self.full_path)
         if direction == 'right':
             self.rect = self.image.get_rect(midleft=player.rect.midright + pygame.math.Vector2(-20, 15))
         elif direction == 'left':
@@ -532,20 +1416,91 @@ class Weapon(pygame.sprite.Sprite):
         else:
             self.rect = self.image.get_rect(midbottom=player.rect.midtop + pygame.math.Vector2(0, 30))
 
+    def kill(self):
+        if self.alive():
+            asset_cache.release(self.full_path)
+        super().kill()
+
 
 class Animation:
     def __init__(self):
-        self.frames = {'mushroom': import_folder('assets/monster/mushroom/defeat'),
-                       'slam': import_folder('assets/monster/mushroom/slam'),
-                       'boss': import_folder('assets/monster/boss/defeat'),
-                       'flame': import_folder('assets/monster/boss/flame'),
-                       'heal': import_folder('assets/magic/heal'),
-                       'dash': import_folder('assets/magic/dash'),
-                       'slash': import_folder('assets/magic/slash')}
+        self.paths = {'mushroom': 'assets/monster/mushroom/defeat', 'slam': 'assets/monster/mushroom/slam',
+                      'boss': 'assets/monster/boss/defeat', 'flame': 'assets/monster/boss/flame',
+                      'heal': 'assets/magic/heal', 'dash': 'assets/magic/dash', 'slash': 'assets/magic/slash'}
+        self.frames = {animation_type: import_folder(path) for animation_type, path in self.paths.items()}
+        self.particles = ParticlePool(self.frames)
+
+    def release(self):
+        for path in self.paths.values():
+            asset_cache.release_folder(path)
+
+    def create_particles(self, animation_type, pos):
+        self.particles.spawn(animation_type, pos)
+
+
+class ParticlePool:
+    def __init__(self, frames, capacity=PARTICLE_POOL_SIZE):
+        self.kinds = {animation_type: kind for kind, animation_type in enumerate(frames)}
+        self.frames = list(frames.values())
+        self.lengths = [len(animation_frames) * PARTICLE_FRAME_SCALE for animation_frames in self.frames]
+        self.half_sizes = [(animation_frames[0].get_width() // 2, animation_frames[0].get_height() // 2)
+                           for animation_frames in self.frames]
+        self.x = array('i')
+        self.y = array('i')
+        self.frame = array('i')
+        self.kind = array('H')
+        self.free = []
+        self.active = []
+        self.visible_slots = []
+        self.capacity = 0
+        self.allocate(capacity)
+
+    def allocate(self, capacity):
+        grow = capacity - self.capacity
+        for buffer in (self.x, self.y, self.frame, self.kind):
+            buffer.extend([0] * grow)
+        self.free.extend(range(capacity - 1, self.capacity - 1, -1))
+        self.capacity = capacity
+
+    def spawn(self, animation_type, pos):
+        if not self.free:
+            self.allocate(self.capacity * 2)
+        slot = self.free.pop()
+        kind = self.kinds[animation_type]
+        half_width, half_height = self.half_sizes[kind]
+        self.x[slot] = int(pos[0]) - half_width
+        self.y[slot] = int(pos[1]) - half_height
+        self.frame[slot] = 0
+        self.kind[slot] = kind
+        self.active.append(slot)
 
-    def create_particles(self, animation_type, pos, groups):
-        animation_frames = self.frames[animation_type]
-        ParticleEffect(pos, animation_frames, groups)
+    def update(self):
+        active = self.active
+        frame = self.frame
+        kept = 0
+        for slot in active:
+            frame[slot] += PARTICLE_FRAME_STEP
+            if frame[slot] >= self.lengths[self.kind[slot]]:
+                self.free.append(slot)
+            else:
+                active[kept] = slot
+                kept += 1
+        del active[kept:]
+
+    def blit_sequence(self, camera_rect):
+        left, top, right, bottom = camera_rect.left, camera_rect.top, camera_rect.right, camera_rect.bottom
+        visible_slots = self.visible_slots
+        visible_slots.clear()
+        blit_sequence = []
+        for slot in self.active:
+            image = self.frames[self.kind[slot]][self.frame[slot] // PARTICLE_FRAME_SCALE]
+            x = self.x[slot]
+            y = self.y[slot]
+            width, height = image.get_size()
+            if x < right and x + width > left and y < bottom and y + height > top:
+                visible_slots.append(slot)
+                blit_sequence.append((image, (x - left, y - top)))
+        return blit_sequence
 
 
 class ParticleEffect(pygame.sprite.Sprite):
@@ -573,16 +1528,16 @@ class MagicAnimation:
     def __init__(self, animation):
         self.animation = animation
 
-    def heal(self, player, damage, cost, groups):
+    def heal(self, player, damage, cost):
         if player.mp >= cost:
             player.hp += damage
             player.mp -= cost
             if player.hp >= player.stats['hp']:
                 player.hp = player.stats['hp']
-            self.animation.create_particles('heal', player.rect.center, groups)
+            self.animation.create_particles('heal', player.rect.center)
 
-    def dash(self, player, damage, cost, groups):
-        self.animation.create_particles('dash', player.rect.center + pygame.math.Vector2(0, 50), groups)
+    def dash(self, player, damage, cost):
+        self.animation.create_particles('dash', player.rect.center + pygame.math.Vector2(0, 50))
 
     def slash(self, player, cost, groups):
         if player.mp >= cost:
@@ -611,7 +1566,7 @@ class MagicAnimation:
             self.sprite_type = 'weapon'
             direction = player.status.split('_')[0]
             full_path = f'assets/magic/slash/{direction}.png'
-            self.image = pygame.image.load(full_path).convert_alpha()
+            self.image = asset_cache.get(full_path)
             if direction == 'right':
                 self.image.get_rect(midleft=player.rect.midright + pygame.math.Vector2(-20, 15))
             elif direction == 'left':
@@ -620,58 +1575,87 @@ class MagicAnimation:
                 self.rect = self.image.get_rect(midtop=player.rect.midbottom + pygame.math.Vector2(0, -30))
             else:
                 self.rect = self.image.get_rect(midbottom=player.rect.midtop + pygame.math.Vector2(0, 30))
-            self.animation.create_particles('slash', player.rect.center, groups)
+            ParticleEffect(player.rect.center, self.animation.frames['slash'], groups)
 class UI:
     def __init__(self):
         self.display_surface = pygame.display.get_surface()
-        self.font = pygame.font.SysFont('arial', 35)
+        self.font = text_cache.font('arial', 35)
         self.hp_bar_rect = pygame.Rect(50, 40, HP_BAR_WIDTH, BAR_HEIGHT)
         self.mp_bar_rect = pygame.Rect(50, 64, MP_BAR_WIDTH, BAR_HEIGHT)
+        self.exp_rect = pygame.Rect(0, 0, 0, 0)
+        self.shown_values = None
+        self.panels = {}
 
     def show_bar(self, current, max_amount, bg_rect, color):
-        pygame.draw.rect(self.display_surface, UI_BG_COLOR, bg_rect)
-        ratio = current / max_amount
-        current_width = bg_rect.width * ratio
-        current_rect = bg_rect.copy()
-        current_rect.width = current_width
-        pygame.draw.rect(self.display_surface, color, current_rect)
-        pygame.draw.rect(self.display_surface, UI_BORDER_COLOR, bg_rect, 3)
+        key = (current, max_amount, color)
+        panel = self.panels.get(bg_rect.topleft)
+        if panel is None or panel[0] != key:
+            surface = pygame.Surface(bg_rect.size)
+            local_rect = surface.get_rect()
+            pygame.draw.rect(surface, UI_BG_COLOR, local_rect)
+            ratio = current / max_amount
+            current_width = bg_rect.width * ratio
+            current_rect = local_rect.copy()
+            current_rect.width = current_width
+            pygame.draw.rect(surface, color, current_rect)
+            pygame.draw.rect(surface, UI_BORDER_COLOR, local_rect, 3)
+            panel = self.panels[bg_rect.topleft] = (key, surface)
+        self.display_surface.blit(panel[1], bg_rect)
 
     def show_exp(self, exp):
-        text_surf = self.font.render(str(int(exp)), False, TEXT_COLOR)
-        x = self.display_surface.get_size()[0] - 60
-        y = self.display_surface.get_size()[1] - 60
-        text_rect = text_surf.get_rect(bottomright=(x, y))
-        pygame.draw.rect(self.display_surface, UI_BG_COLOR, text_rect.inflate(20, 20))
-        self.display_surface.blit(text_surf, text_rect)
-        pygame.draw.rect(self.display_surface, UI_BORDER_COLOR, text_rect.inflate(20, 20), 3)
+        text = str(int(exp))
+        panel = self.panels.get('exp')
+        if panel is None or panel[0] != text:
+            text_surf = text_cache.render(self.font, text, TEXT_COLOR, False)
+            x = self.display_surface.get_size()[0] - 60
+            y = self.display_surface.get_size()[1] - 60
+            box_rect = text_surf.get_rect(bottomright=(x, y)).inflate(20, 20)
+            surface = pygame.Surface(box_rect.size)
+            local_rect = surface.get_rect()
+            pygame.draw.rect(surface, UI_BG_COLOR, local_rect)
+            surface.blit(text_surf, (10, 10))
+            pygame.draw.rect(surface, UI_BORDER_COLOR, local_rect, 3)
+            panel = self.panels['exp'] = (text, surface, box_rect)
+        self.display_surface.blit(panel[1], panel[2])
+        return panel[2]
 
     def display(self, player):
         self.show_bar(player.hp, player.stats['hp'], self.hp_bar_rect, HP_COLOR)
         self.show_bar(player.mp, player.stats['mp'], self.mp_bar_rect, MP_COLOR)
-        self.show_exp(player.exp)
+        exp_rect = self.show_exp(player.exp)
+        values = (player.hp, player.mp, int(player.exp))
+        dirty_rects = []
+        if self.shown_values is None or values[0] != self.shown_values[0]:
+            dirty_rects.append(self.hp_bar_rect)
+        if self.shown_values is None or values[1] != self.shown_values[1]:
+            dirty_rects.append(self.mp_bar_rect)
+        if self.shown_values is None or values[2] != self.shown_values[2]:
+            dirty_rects.append(exp_rect.union(self.exp_rect))
+        self.shown_values = values
+        self.exp_rect = exp_rect
+        return dirty_rects
 
 
 class PauseScreen:
     def __init__(self, player):
         self.display_surface = pygame.display.get_surface()
         self.player = player
+        self.surface = self.compose()
+
+    def compose(self):
+        surface = pygame.Surface(self.display_surface.get_size())
+        surface.fill((0, 50, 100))
+        controls_font = text_cache.font('arial', 35)
+        controls_label = text_cache.render(controls_font, "Controls", 'white')
+        lines = ["Arrow keys: move player", "Space bar: dash", "Q:Attack", "W:Heal Magic", "Esc/I/C/M:Pause"]
+        surface.blit(controls_label, (WINDOW_WIDTH // 2 - controls_label.get_width(), 200))
+        for index, line in enumerate(lines):
+            controls_display = text_cache.render(controls_font, line, 'white')
+            surface.blit(controls_display, (WINDOW_WIDTH // 2 - controls_label.get_width(), 250 + index * 50))
+        return surface
 
     def display(self):
-        self.display_surface.fill((0, 50, 100))
-        controls_font = pygame.font.SysFont('Arial', 35)
-        controls_label = controls_font.render("Controls", 1, 'white')
-        controls_display = controls_font.render("Arrow keys: move player", 1, 'white')
-        controls_display2 = controls_font.render("Space bar: dash", 1, 'white')
-        controls_display3 = controls_font.render("Q:Attack", 1, 'white')
-        controls_display4 = controls_font.render("W:Heal Magic", 1, 'white')
-        controls_display5 = controls_font.render("Esc/I/C/M:Pause", 1, 'white')
-        WINDOW.blit(controls_label, (WINDOW_WIDTH // 2 - controls_label.get_width(), 200))
-        WINDOW.blit(controls_display, (WINDOW_WIDTH // 2 - controls_label.get_width(), 250))
-        WINDOW.blit(controls_display2, (WINDOW_WIDTH // 2 - controls_label.get_width(), 300))
-        WINDOW.blit(controls_display3, (WINDOW_WIDTH // 2 - controls_label.get_width(), 350))
-        WINDOW.blit(controls_display4, (WINDOW_WIDTH // 2 - controls_label.get_width(), 400))
-        WINDOW.blit(controls_display5, (WINDOW_WIDTH // 2 - controls_label.get_width(), 450))
+        self.display_surface.blit(self.surface, (0, 0))
 
 
 class UpgradeMenu:
@@ -682,7 +1666,7 @@ class UpgradeMenu:
         self.attribute_names = list(player.stats.keys())
         self.height = self.display_surface.get_size()[1] * 0.8
         self.width = self.display_surface.get_size()[0] // 6
-        self.font = pygame.font.SysFont('Arial', 35)
+        self.font = text_cache.font('arial', 35)
         self.create_items()
         self.selection_index = 0
         self.selection_time = None
@@ -714,18 +1698,227 @@ class MenuItem:
         pygame.draw.rect(surface, 'grey', self.rect)
 
 
+class AssetCache:
+    def __init__(self, budget=ASSET_CACHE_BUDGET, baked_dir=BAKED_ASSETS_DIR):
+        self.budget = budget
+        self.baked_dir = baked_dir
+        self.manifest = None
+        self.atlases = weakref.WeakValueDictionary()
+        self.entries = OrderedDict()
+        self.ref_counts = {}
+        self.folders = {}
+        self.clips = {}
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, path, size=None, alpha=True, source=None):
+        key = (path, size, alpha)
+        surface = self.entries.get(key)
+        if surface is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return surface
+        self.misses += 1
+        baked = self.baked(path, size)
+        if baked is not None:
+            surface = self.atlas(os.path.join(self.baked_dir, baked['atlas']), alpha, source).subsurface(baked['rect'])
+        else:
+            surface = source if source is not None else pygame.image.load(path)
+            if pygame.display.get_surface() is not None:
+                surface = surface.convert_alpha() if alpha else surface.convert()
+            if size is not None:
+                surface = pygame.transform.scale(surface, size)
+        self.entries[key] = surface
+        self.ref_counts.setdefault(key, 0)
+        self.resident_bytes += self.surface_bytes(surface)
+        self.evict(keep=key)
+        return surface
+
+    def load_manifest(self):
+        try:
+            with open(os.path.join(self.baked_dir, 'manifest.json')) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {'images': {}, 'folders': {}}
+
+    def baked(self, path, size=None):
+        if self.manifest is None:
+            self.manifest = self.load_manifest()
+        entry = self.manifest['images'].get(path if size is None else f'{path}@{size[0]}x{size[1]}')
+        if entry is None:
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return entry
+        if [stat.st_mtime_ns, stat.st_size] != entry['source']:
+            return None
+        return entry
+
+    def source_file(self, path, size=None):
+        baked = self.baked(path, size)
+        return os.path.join(self.baked_dir, baked['atlas']) if baked else path
+
+    def atlas(self, atlas_path, alpha=True, source=None):
+        key = (atlas_path, alpha)
+        atlas = self.atlases.get(key)
+        if atlas is None:
+            atlas = source if source is not None else pygame.image.load(atlas_path)
+            if pygame.display.get_surface() is not None:
+                atlas = atlas.convert_alpha() if alpha else atlas.convert()
+            self.atlases[key] = atlas
+        return atlas
+
+    def load(self, path, size=None, alpha=True):
+        surface = self.get(path, size, alpha)
+        self.ref_counts[(path, size, alpha)] += 1
+        return surface
+
+    def release(self, path, size=None, alpha=True):
+        key = (path, size, alpha)
+        if self.ref_counts.get(key, 0) > 0:
+            self.ref_counts[key] -= 1
+        self.evict()
+
+    def folder_paths(self, path):
+        paths = self.folders.get(path)
+        if paths is None:
+            if self.manifest is None:
+                self.manifest = self.load_manifest()
+            baked = self.manifest['folders'].get(path)
+            if baked is not None and os.stat(path).st_mtime_ns == baked['mtime']:
+                paths = baked['files']
+            else:
+                paths = []
+                for _, __, img_files in walk(path):
+                    for image in sorted(img_files):
+                        paths.append(path + '/' + image)
+            self.folders[path] = paths
+        return paths
+
+    def load_folder(self, path, size=None):
+        return [self.load(full_path, size) for full_path in self.folder_paths(path)]
+
+    def load_clip(self, path):
+        frames = self.load_folder(path)
+        clip = self.clips.get(path)
+        if clip is None or clip.frames != frames:
+            clip = self.clips[path] = AnimationClip(frames)
+        return clip
+
+    def release_folder(self, path, size=None):
+        for full_path in self.folder_paths(path):
+            self.release(full_path, size)
+
+    def evict(self, keep=None):
+        if self.resident_bytes <= self.budget:
+            return
+        for key in list(self.entries):
+            if self.resident_bytes <= self.budget:
+                break
+            if self.ref_counts[key] == 0 and key != keep:
+                surface = self.entries.pop(key)
+                del self.ref_counts[key]
+                self.clips.pop(key[0].rsplit('/', 1)[0], None)
+                self.resident_bytes -= self.surface_bytes(surface)
+                self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0, 'entries': len(self.entries),
+                'resident_bytes': self.resident_bytes}
+
+    @staticmethod
+    def surface_bytes(surface):
+        return surface.get_bytesize() * surface.get_width() * surface.get_height()
+
+
+asset_cache = AssetCache()
+
+
+class AssetPreloader:
+    def __init__(self, keys, workers=PRELOAD_WORKERS):
+        self.keys = keys
+        self.pending = deque(keys)
+        self.finalized = 0
+        executor = ThreadPoolExecutor(workers)
+        self.sources = {key: asset_cache.source_file(key[0], key[1]) for key in keys}
+        self.futures = {source: executor.submit(pygame.image.load, source)
+                        for source in dict.fromkeys(self.sources.values())}
+        executor.shutdown(wait=False)
+
+    @property
+    def finished(self):
+        return not self.pending
+
+    @property
+    def progress(self):
+        return self.finalized / len(self.keys) if self.keys else 1.0
+
+    def finalize(self, time_budget=PRELOAD_FRAME_BUDGET):
+        start = time.perf_counter()
+        while self.pending:
+            path, size, alpha = self.pending[0]
+            future = self.futures[self.sources[self.pending[0]]]
+            if time_budget is not None and (not future.done() or time.perf_counter() - start > time_budget):
+                break
+            asset_cache.get(path, size, alpha, future.result())
+            self.pending.popleft()
+            self.finalized += 1
+        return self.finished
+
+
+def preload_keys():
+    keys = [('assets/environment/grass3.jpg', None, False), ('assets/environment/desert4.jpg', None, False)]
+    keys.extend((path, size, True) for path, size in SCALED_ASSETS)
+    for folder in PRELOAD_FOLDERS:
+        for directory, _, img_files in sorted(walk(folder)):
+            for image in sorted(img_files):
+                keys.append((directory + '/' + image, None, True))
+    return keys
+
+
 def import_folder(path):
-    surface_list = []
-    for _, __, img_files in walk(path):
-        for image in img_files:
-            full_path = path + '/' + image
-            image_surf = pygame.image.load(full_path).convert_alpha()
-            surface_list.append(image_surf)
-    return surface_list
+    return asset_cache.load_folder(path)
+
+
+class TextCache:
+    def __init__(self, capacity=TEXT_CACHE_SIZE):
+        self.capacity = capacity
+        self.fonts = {}
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def font(self, name, size):
+        key = (name.lower() if name else None, size)
+        font = self.fonts.get(key)
+        if font is None:
+            font = self.fonts[key] = pygame.font.SysFont(name, size) if name else pygame.font.Font(None, size)
+        return font
+
+    def render(self, font, text, color, antialias=True):
+        key = (font, text, color, antialias)
+        surface = self.entries.get(key)
+        if surface is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return surface
+        self.misses += 1
+        surface = self.entries[key] = font.render(text, antialias, color)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+        return surface
+
+
+text_cache = TextCache()
 
 
 # Debug
-font = pygame.font.Font(None, 30)
+font = text_cache.font(None, 30)
 
 
 def debug(info, y=10, x=10):
@@ -736,47 +1929,287 @@ def debug(info, y=10, x=10):
     display_surface.blit(debug_surf, debug_rect)
 
 
+class ProfileScope:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.name, self.start, time.perf_counter())
+        return False
+
+
+class Profiler:
+    def __init__(self, history=PROFILER_HISTORY, trace_events=PROFILER_TRACE_EVENTS):
+        self.history_length = history
+        self.scopes = {}
+        self.frame_times = {}
+        self.frame_counters = {}
+        self.history = {}
+        self.counter_history = {}
+        self.last_frame = {}
+        self.last_counters = {}
+        self.events = deque(maxlen=trace_events)
+        self.frame = 0
+        self.frame_start = None
+        self.origin = time.perf_counter()
+        self.show_overlay = False
+
+    def scope(self, name):
+        scope = self.scopes.get(name)
+        if scope is None:
+            scope = self.scopes[name] = ProfileScope(self, name)
+        return scope
+
+    def record(self, name, start, end):
+        self.frame_times[name] = self.frame_times.get(name, 0.0) + end - start
+        self.events.append((name, start, end - start, self.frame))
+
+    def count(self, name, amount=1):
+        self.frame_counters[name] = self.frame_counters.get(name, 0) + amount
+
+    def begin_frame(self):
+        self.frame_start = time.perf_counter()
+
+    def end_frame(self):
+        if self.frame_start is not None:
+            self.record('frame', self.frame_start, time.perf_counter())
+        for name, seconds in self.frame_times.items():
+            if name not in self.history:
+                self.history[name] = deque(maxlen=self.history_length)
+            self.history[name].append(seconds * 1000)
+        for name, amount in self.frame_counters.items():
+            if name not in self.counter_history:
+                self.counter_history[name] = deque(maxlen=self.history_length)
+            self.counter_history[name].append(amount)
+        self.last_frame = {name: seconds * 1000 for name, seconds in self.frame_times.items()}
+        self.last_counters = self.frame_counters
+        self.frame_times = {}
+        self.frame_counters = {}
+        self.frame_start = None
+        self.frame += 1
+
+    def toggle_overlay(self):
+        self.show_overlay = not self.show_overlay
+
+    def draw_overlay(self, x=10, y=110):
+        for name, samples in self.history.items():
+            debug(f"{name}: {samples[-1]:.2f} ms (avg {sum(samples) / len(samples):.2f})", y, x)
+            y += 22
+        for name, samples in self.counter_history.items():
+            debug(f"{name}: {samples[-1]}", y, x)
+            y += 22
+        frame_samples = self.history.get('frame')
+        if frame_samples and len(frame_samples) > 1:
+            display_surface = pygame.display.get_surface()
+            graph_rect = pygame.Rect(x, y + 5, self.history_length * 2, 64)
+            pygame.draw.rect(display_surface, 'Black', graph_rect)
+            budget_y = graph_rect.bottom - min(1000 / FPS * 2, graph_rect.height)
+            pygame.draw.line(display_surface, 'Red', (graph_rect.left, budget_y), (graph_rect.right, budget_y))
+            points = [(graph_rect.left + index * 2, graph_rect.bottom - min(sample * 2, graph_rect.height))
+                      for index, sample in enumerate(frame_samples)]
+            pygame.draw.lines(display_surface, 'White', False, points)
+
+    def export_chrome_trace(self, path):
+        trace_events = [{'name': name, 'ph': 'X', 'ts': (start - self.origin) * 1e6, 'dur': duration * 1e6,
+                         'pid': 0, 'tid': 0, 'args': {'frame': frame}}
+                        for name, start, duration, frame in self.events]
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, file)
+
+    def export_csv(self, path):
+        with open(path, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['frame', 'scope', 'start_ms', 'duration_ms'])
+            for name, start, duration, frame in self.events:
+                writer.writerow([frame, name, f'{(start - self.origin) * 1000:.4f}', f'{duration * 1000:.4f}'])
+
+
+profiler = Profiler()
+
+
+class Game:
+    def __init__(self):
+        self.clock = pygame.time.Clock()
+        self.world_clock = SimulationClock()
+        self.accumulator = 0.0
+        self.last_frame = time.perf_counter()
+        self.recorder = None
+        self.world = None
+        self.scene = 'menu'
+        self.scene_time = 0
+        self.running = True
+        self.preloader = AssetPreloader(preload_keys())
+        self.menu_surface = self.compose_menu()
+        self.lost_label = text_cache.render(text_cache.font('arial', 60), "Game Over", 'white')
+
+    def compose_menu(self):
+        title_font = text_cache.font('arial', 70)
+        menu_surface = asset_cache.get('assets/main_menu/background.jpg', alpha=False).copy()
+        title_label = text_cache.render(title_font, "GameDesign3 Prototype by CapyTech", 'white')
+        start_label = text_cache.render(title_font, "Click anywhere to begin", 'white')
+        menu_surface.blit(title_label, (WINDOW_WIDTH // 2 - title_label.get_width() // 2, 250))
+        menu_surface.blit(start_label, (WINDOW_WIDTH // 2 - start_label.get_width() // 2, 350))
+        return menu_surface
+
+    def show_progress(self, progress):
+        bg_rect = pygame.Rect(0, 0, WINDOW_WIDTH // 3, BAR_HEIGHT)
+        bg_rect.center = (WINDOW_WIDTH // 2, 480)
+        current_rect = bg_rect.copy()
+        current_rect.width = bg_rect.width * progress
+        pygame.draw.rect(WINDOW, UI_BG_COLOR, bg_rect)
+        pygame.draw.rect(WINDOW, HP_COLOR, current_rect)
+        pygame.draw.rect(WINDOW, UI_BORDER_COLOR, bg_rect, 3)
+
+    def change_scene(self, scene):
+        self.scene = scene
+        self.scene_time = pygame.time.get_ticks()
+        if self.world:
+            self.world.visible_sprites.full_redraw = True
+
+    def start_world(self):
+        self.end_world()
+        self.preloader.finalize(None)
+        self.world_clock = SimulationClock()
+        self.accumulator = 0.0
+        if RECORD_FILE:
+            self.recorder = InputRecorder(tick_rate=FPS)
+            self.world = World(clock=self.world_clock, get_pressed=self.recorder, interpolate=True)
+        else:
+            self.world = World(clock=self.world_clock, interpolate=True)
+        self.change_scene('playing')
+
+    def end_world(self):
+        if self.world:
+            if self.recorder:
+                self.recorder.log.digest = self.world.digest()
+                self.recorder.log.save(RECORD_FILE)
+                self.recorder = None
+            self.world.teardown()
+            self.world = None
+
+    def handle_event(self, event):
+        if event.type == pygame.QUIT:
+            self.running = False
+        elif self.scene == 'menu':
+            if event.type == pygame.MOUSEBUTTONDOWN or event.type == pygame.KEYDOWN:
+                self.start_world()
+        elif event.type == pygame.KEYDOWN:
+            if self.recorder:
+                self.recorder.record_event(event.key)
+            if event.key == pygame.K_ESCAPE or event.key == pygame.K_i:
+                if self.scene == 'playing':
+                    self.change_scene('paused')
+                elif self.scene == 'paused':
+                    self.change_scene('playing')
+            if event.key == pygame.K_c or event.key == pygame.K_m:
+                if self.scene == 'playing':
+                    self.change_scene('upgrade')
+                elif self.scene == 'upgrade':
+                    self.change_scene('playing')
+            if event.key == pygame.K_F3:
+                profiler.toggle_overlay()
+                if self.world:
+                    self.world.visible_sprites.full_redraw = True
+            if event.key == pygame.K_F4:
+                profiler.export_chrome_trace('profile_trace.json')
+                profiler.export_csv('profile.csv')
+
+    def advance_world(self, elapsed):
+        world = self.world
+        tick_time = self.world_clock.step
+        self.accumulator += elapsed
+        ticks = 0
+        while self.accumulator >= tick_time and ticks < MAX_CATCH_UP_TICKS:
+            if self.recorder:
+                self.recorder.capture()
+            self.world_clock.tick()
+            world.step()
+            self.accumulator -= tick_time
+            ticks += 1
+            if world.game_over:
+                break
+        if self.accumulator >= tick_time:
+            self.accumulator %= tick_time
+        profiler.count('ticks', ticks)
+
+    def update(self, elapsed):
+        if self.scene == 'menu':
+            WINDOW.blit(self.menu_surface, (0, 0))
+            if not self.preloader.finished:
+                self.preloader.finalize()
+                self.show_progress(self.preloader.progress)
+            return None
+        world = self.world
+        if self.scene == 'playing':
+            self.advance_world(elapsed)
+            if world.game_over:
+                self.change_scene('game_over')
+        if not DIRTY_RECTS:
+            WINDOW.fill('white')
+        dirty_rects = world.draw(self.accumulator / self.world_clock.step)
+        if self.scene == 'playing':
+            return dirty_rects
+        if self.scene == 'paused':
+            world.pause_screen.display()
+        elif self.scene == 'upgrade':
+            world.upgrade_menu.display()
+        elif self.scene == 'game_over':
+            if world.game_over == 'lost':
+                WINDOW.blit(self.lost_label, (WINDOW_WIDTH // 2 - self.lost_label.get_width() // 2, 350))
+            if pygame.time.get_ticks() - self.scene_time >= GAME_OVER_DELAY:
+                self.end_world()
+                self.change_scene('menu')
+                return None
+        world.visible_sprites.full_redraw = True
+        return None
+
+    def run(self):
+        while self.running:
+            self.clock.tick(RENDER_FPS)
+            now = time.perf_counter()
+            elapsed = (now - self.last_frame) * 1000
+            self.last_frame = now
+            profiler.begin_frame()
+            dirty_rects = self.update(elapsed)
+            if profiler.show_overlay:
+                profiler.draw_overlay()
+                dirty_rects = None
+                if self.world:
+                    self.world.visible_sprites.full_redraw = True
+            with profiler.scope('display_flip'):
+                if dirty_rects is None:
+                    pygame.display.update()
+                else:
+                    pygame.display.update(dirty_rects)
+            profiler.end_frame()
+            for event in pygame.event.get():
+                self.handle_event(event)
+        self.end_world()
+        pygame.quit()
+        sys.exit()
+
+
 def main():
-    clock = pygame.time.Clock()
-    world = World()
-    run = True
-    while run:
-        clock.tick(FPS)
-        WINDOW.fill('white')
-        world.run()
-        pygame.display.update()
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                run = False
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_ESCAPE or event.key == pygame.K_i:
-                    world.toggle_pause()
-                if event.key == pygame.K_c or event.key == pygame.K_m:
-                    world.toggle_menu()
-    pygame.quit()
-    sys.exit()
-
-
-def main_menu():
-    title_font = pygame.font.SysFont("arial", 70)
-    run = True
-    while run:
-        background = pygame.image.load('assets/main_menu/background.jpg')
-        WINDOW.blit(background, (0, 0))
-        title_label = title_font.render("GameDesign3 Prototype by CapyTech", 1, 'white')
-        start_label = title_font.render("Click anywhere to begin", 1, 'white')
-        WINDOW.blit(title_label, (WINDOW_WIDTH // 2 - title_label.get_width() // 2, 250))
-        WINDOW.blit(start_label, (WINDOW_WIDTH // 2 - start_label.get_width() // 2, 350))
-        pygame.display.update()
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                run = False
-            if event.type == pygame.MOUSEBUTTONDOWN:
-                main()
-            if event.type == pygame.KEYDOWN:
-                main()
-    exit()
+    Game().run()
+
+
+def run_headless(ticks=int(os.environ.get('CAPY_TICKS', 3600))):
+    clock = SimulationClock()
+    world = World(clock=clock, headless=True)
+    start = time.perf_counter()
+    played = simulate(world, clock, ticks)
+    elapsed = time.perf_counter() - start
+    print(f"{played} ticks in {elapsed:.2f}s ({played / elapsed:.0f} ticks/s), game over: {world.game_over}")
 
 
 if __name__ == "__main__":
-    main_menu()
+    if HEADLESS:
+        run_headless()
+    else:
+        main()
@@ -0,0 +1,115 @@
+# author: Paul Kim
+# date: October 9, 2022
+# version: 1.0
+import mmap
+import re
+import struct
+import sys
+from bisect import bisect_left
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = b'CAPYMAP1'
+HEADER = struct.Struct('<8sIIIii4x')
+SPAWN = struct.Struct('<IIB3x')
+SPAWN_KINDS = ('p', 'm', 'b')
+TERRAIN = re.compile(rb'[^ ]')
+if numpy is not None:
+    SPAWN_DTYPE = numpy.dtype({'names': ['row', 'col', 'kind'], 'formats': ['<u4', '<u4', 'u1'],
+                               'offsets': [0, 4, 8], 'itemsize': SPAWN.size})
+
+
+class MapData:
+    def __init__(self, cols, rows, grid, spawn_keys, spawn_kinds, player=None, source=None):
+        self.cols = cols
+        self.rows = rows
+        self.grid = grid
+        self.spawn_keys = spawn_keys
+        self.spawn_kinds = spawn_kinds
+        self.player = player
+        self.source = source
+
+    @classmethod
+    def from_rows(cls, world_map):
+        rows = len(world_map)
+        cols = len(world_map[0])
+        grid = bytearray(b' ' * (cols * rows))
+        spawn_keys = []
+        spawn_kinds = bytearray()
+        player = None
+        for row_index, row in enumerate(world_map):
+            start = row_index * cols
+            for col_index, col in enumerate(row):
+                if col in SPAWN_KINDS:
+                    spawn_keys.append(start + col_index)
+                    spawn_kinds.append(ord(col))
+                    if col == 'p' and player is None:
+                        player = (col_index, row_index)
+                elif col and col != ' ':
+                    grid[start + col_index] = ord(col)
+        return cls(cols, rows, bytes(grid), spawn_keys, bytes(spawn_kinds), player)
+
+    def cells(self, left=0, top=0, right=None, bottom=None):
+        right = self.cols if right is None else min(right, self.cols)
+        bottom = self.rows if bottom is None else min(bottom, self.rows)
+        for row_index in range(top, bottom):
+            start = row_index * self.cols
+            row_cells = [(match.start() - start, chr(self.grid[match.start()]))
+                         for match in TERRAIN.finditer(self.grid, start + left, start + right)]
+            index = bisect_left(self.spawn_keys, start + left)
+            while index < len(self.spawn_keys) and self.spawn_keys[index] < start + right:
+                row_cells.append((int(self.spawn_keys[index]) - start, chr(self.spawn_kinds[index])))
+                index += 1
+            row_cells.sort()
+            for col_index, col in row_cells:
+                yield col_index, row_index, col
+
+    def save(self, path):
+        player = self.player or (-1, -1)
+        with open(path, 'wb') as file:
+            file.write(HEADER.pack(MAGIC, self.cols, self.rows, len(self.spawn_keys), player[0], player[1]))
+            file.write(self.grid)
+            file.write(b'\0' * (spawn_offset(self.cols, self.rows) - HEADER.size - len(self.grid)))
+            for key, kind in zip(self.spawn_keys, self.spawn_kinds):
+                file.write(SPAWN.pack(int(key) // self.cols, int(key) % self.cols, kind))
+
+
+def spawn_offset(cols, rows):
+    return (HEADER.size + cols * rows + 7) // 8 * 8
+
+
+def load_map(path):
+    with open(path, 'rb') as file:
+        buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, cols, rows, spawn_count, player_col, player_row = HEADER.unpack_from(buffer)
+    if magic != MAGIC:
+        raise ValueError(f'{path} is not a map file')
+    grid = memoryview(buffer)[HEADER.size:HEADER.size + cols * rows]
+    offset = spawn_offset(cols, rows)
+    if numpy is not None:
+        spawns = numpy.frombuffer(buffer, SPAWN_DTYPE, spawn_count, offset)
+        spawn_keys = spawns['row'].astype(numpy.int64) * cols + spawns['col']
+        spawn_kinds = spawns['kind']
+    else:
+        spawns = list(SPAWN.iter_unpack(buffer[offset:offset + spawn_count * SPAWN.size]))
+        spawn_keys = [row * cols + col for row, col, kind in spawns]
+        spawn_kinds = bytes(kind for row, col, kind in spawns)
+    player = (player_col, player_row) if player_col >= 0 else None
+    return MapData(cols, rows, grid, spawn_keys, spawn_kinds, player, path)
+
+
+def convert(world_map, path):
+    map_data = MapData.from_rows(world_map)
+    map_data.save(path)
+    return map_data
+
+
+if __name__ == "__main__":
+    from world_map import WORLD_MAP
+
+    output = sys.argv[1] if len(sys.argv) > 1 else 'world_map.capymap'
+    converted = convert(WORLD_MAP, output)
+    print(f"wrote {output}: {converted.cols}x{converted.rows}, {len(converted.spawn_keys)} spawns")
@@ -0,0 +1,73 @@
+# author: Paul Kim
+# date: October 9, 2022
+# version: 1.0
+import argparse
+import json
+import os
+import time
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import pygame
+
+from benchmark import PHASES, git_revision, summarize
+from input_log import InputReplay, load_log
+from main import WINDOW, World, SimulationClock, profiler
+
+
+def replay(path, render=True):
+    log = load_log(path)
+    clock = SimulationClock(1000 / log.tick_rate)
+    player_input = InputReplay(log)
+    world = World(clock=clock, get_pressed=player_input, headless=not render)
+    events = list(reversed(log.events))
+    timings = {phase: [] for phase in PHASES}
+    handled_events = 0
+    start = time.perf_counter()
+    while not player_input.finished:
+        player_input.capture()
+        while events and events[-1][0] <= player_input.tick:
+            tick, key = events.pop()
+            if key == pygame.K_F3:
+                profiler.toggle_overlay()
+            handled_events += 1
+        clock.tick()
+        profiler.begin_frame()
+        if render:
+            WINDOW.fill('white')
+        world.run()
+        if render and profiler.show_overlay:
+            profiler.draw_overlay()
+        profiler.end_frame()
+        for phase in PHASES:
+            timings[phase].append(profiler.last_frame.get(phase, 0.0))
+    elapsed = time.perf_counter() - start
+    if profiler.show_overlay:
+        profiler.toggle_overlay()
+    digest = world.digest()
+    return {'log': path, 'ticks': log.ticks, 'events': handled_events, 'render': render, 'seconds': elapsed,
+            'matches_recording': digest == log.digest, 'game_over': world.game_over,
+            'phases': {phase: summarize(samples) for phase, samples in timings.items() if samples}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a recorded input log and time every tick.')
+    parser.add_argument('log', help='input log written by running the game with CAPY_RECORD set')
+    parser.add_argument('--headless', action='store_true', help='skip drawing and only time the simulation')
+    parser.add_argument('--output', default='replay_results.json')
+    args = parser.parse_args()
+    result = replay(args.log, not args.headless)
+    print(f"{result['log']}: {result['ticks']} ticks, {result['events']} events in {result['seconds']:.2f}s, "
+          f"{'matches' if result['matches_recording'] else 'DIFFERS FROM'} recording")
+    for phase, summary in result['phases'].items():
+        print(f"  {phase:<20} mean {summary['mean_ms']:7.3f}  p95 {summary['p95_ms']:7.3f}  "
+              f"p99 {summary['p99_ms']:7.3f} ms")
+    report = {'revision': git_revision(), 'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'result': result}
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()